@@ -3,7 +3,7 @@
 from .base import AITool, ConversationAgent, MemoryManager, AIResponse
 from .tools import AVAILABLE_TOOLS, create_tool, get_available_tool_names
 from .memory import memory_manager
-from .agent import conversation_agent
+from .agent import conversation_agent, llm
 from .service import ai_service
 
 __all__ = [
@@ -16,5 +16,6 @@ __all__ = [
     'get_available_tool_names',
     'memory_manager',
     'conversation_agent',
+    'llm',
     'ai_service'
 ]
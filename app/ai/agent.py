@@ -5,18 +5,27 @@ This module contains the main conversation agent that uses LangChain
 for processing user messages and generating responses.
 """
 
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+from contextvars import ContextVar
 import asyncio
+import inspect
+from functools import lru_cache
+import httpx
 from langchain_xai import ChatXAI
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.schema import SystemMessage
-from langchain.agents import initialize_agent, Tool, AgentType
-from langchain.memory import ConversationBufferMemory
+from langchain.agents import AgentExecutor, Tool, create_tool_calling_agent
 
 from .base import ConversationAgent, AITool, AIResponse
 from .memory import memory_manager
 from .tools import AVAILABLE_TOOLS, create_tool
-from ..config import LLM_MODEL, LLM_TEMPERATURE, XAI_API_KEY
+from ..config import (
+    LLM_MODEL,
+    LLM_TEMPERATURE,
+    XAI_API_KEY,
+    TOOL_TIMEOUT,
+    LLM_MAX_KEEPALIVE_CONNECTIONS
+)
 from ..utils.logging import get_logger, log_user_query, log_model_answer
 from ..utils.text import normalize_text
 from ..utils.language import detect_language
@@ -24,19 +33,74 @@ from ..utils.language import detect_language
 # Setup logger
 agent_logger = get_logger('ai_agent')
 
+# Shared chat model; one pooled HTTP client serves the agent and memory summarization
+llm = ChatXAI(
+    api_key=XAI_API_KEY,
+    model=LLM_MODEL,
+    temperature=LLM_TEMPERATURE,
+    http_async_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS)
+    )
+)
+
+
+# Per-call tool context; ContextVar keeps concurrent process_message calls isolated
+_tool_context: ContextVar[Optional[Dict[str, Any]]] = ContextVar('ai_tool_context', default=None)
+
+# Agent prompt for native tool calling; per-user history is supplied on each call
+_AGENT_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessage(content=(
+        "You are a helpful multilingual assistant. Use the available tools when "
+        "they help answer the user's question, then reply directly to the user."
+    )),
+    MessagesPlaceholder(variable_name="chat_history", optional=True),
+    ("human", "{input}"),
+    MessagesPlaceholder(variable_name="agent_scratchpad")
+])
+
+# Prompt skeleton for _build_enhanced_message; only the placeholders vary per call
+_ENHANCED_MESSAGE_TEMPLATE = """User Question: {message}
+
+Context:
+{context}
+
+Instructions:
+1. Consider the previous conversation context when responding
+2. Provide a direct and natural response
+3. Don't mention that you're using tools or searching documents
+4. Keep the response concise and focused
+5. Use a conversational but professional tone
+6. Respond in {language} language
+7. If information isn't available, say so briefly
+"""
+
+
+@lru_cache(maxsize=2048)
+def _cached_detect_language(message: str) -> str:
+    """Memoized detect_language; repeated/retried messages skip detection"""
+    return detect_language(message)
+
+
+@lru_cache(maxsize=2048)
+def _cached_normalize_text(message: str) -> str:
+    """Memoized normalize_text; it is a pure function of the input"""
+    return normalize_text(message)
+
 
 class LangChainConversationAgent(ConversationAgent):
     """LangChain-based conversation agent"""
     
     def __init__(self):
-        self.llm = ChatXAI(
-            api_key=XAI_API_KEY,
-            model=LLM_MODEL,
-            temperature=LLM_TEMPERATURE
-        )
+        self.llm = llm
         self.tools: Dict[str, AITool] = {}
+        # LangChain wrappers built once per tool, reused across agent rebuilds
+        self._langchain_tools: Dict[str, Tool] = {}
         self.memory_manager = memory_manager
+        if self.memory_manager.llm is None:
+            self.memory_manager.llm = self.llm
         self.agent = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tools_dirty = False
         self._setup_default_tools()
         self._setup_agent()
     
@@ -45,84 +109,103 @@ class LangChainConversationAgent(ConversationAgent):
         # Add document query tool
         doc_tool = create_tool("document_query")
         if doc_tool:
-            self.tools[doc_tool.name] = doc_tool
+            self._register_tool(doc_tool)
         
         # Add language detection tool
         lang_tool = create_tool("language_detection")
         if lang_tool:
-            self.tools[lang_tool.name] = lang_tool
+            self._register_tool(lang_tool)
         
         # Add conversation history tool
         hist_tool = create_tool("conversation_history")
         if hist_tool:
-            self.tools[hist_tool.name] = hist_tool
+            self._register_tool(hist_tool)
         
         # Add YouTube transcript tool
         youtube_tool = create_tool("youtube_transcript")
         if youtube_tool:
-            self.tools[youtube_tool.name] = youtube_tool
+            self._register_tool(youtube_tool)
         
         agent_logger.info(f"🔧 Initialized agent with {len(self.tools)} default tools")
     
+    def _register_tool(self, tool: AITool) -> None:
+        """Store a tool and its LangChain wrapper (name/description read once here)"""
+        self.tools[tool.name] = tool
+        self._langchain_tools[tool.name] = Tool(
+            # Function-calling APIs only accept [a-zA-Z0-9_-] in tool names
+            name=tool.name.lower().replace(" ", "_"),
+            func=self._create_sync_wrapper(tool),
+            coroutine=self._create_async_wrapper(tool),
+            description=tool.description
+        )
+    
     def _setup_agent(self):
         """Setup the LangChain agent"""
-        # Convert AI tools to LangChain tools
-        langchain_tools = []
-        for tool in self.tools.values():
-            langchain_tool = Tool(
-                name=tool.name,
-                func=self._create_sync_wrapper(tool),
-                description=tool.description
-            )
-            langchain_tools.append(langchain_tool)
+        langchain_tools = list(self._langchain_tools.values())
         
-        # Initialize agent
-        self.agent = initialize_agent(
+        # Tool calls come back as structured function calls, so there is no
+        # ReAct text to parse and no parse-error retry loop
+        agent = create_tool_calling_agent(self.llm, langchain_tools, _AGENT_PROMPT)
+        self.agent = AgentExecutor(
+            agent=agent,
             tools=langchain_tools,
-            llm=self.llm,
-            agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
             verbose=True,
-            handle_parsing_errors=True,
-            max_iterations=3,
-            memory=ConversationBufferMemory(
-                memory_key="chat_history",
-                return_messages=True
-            )
+            max_iterations=3
         )
+        self._tools_dirty = False
         
         agent_logger.debug("🤖 LangChain agent initialized")
     
+    @staticmethod
+    def _format_tool_result(result: Any) -> str:
+        """Format a tool result as a string for the agent"""
+        if isinstance(result, dict):
+            if 'error' in result:
+                return f"Error: {result['error']}"
+            elif 'answer' in result:
+                return result['answer']
+            else:
+                return str(result)
+        return str(result)
+
+    def _create_async_wrapper(self, tool: AITool):
+        """Create a coroutine wrapper so the agent awaits tools on its own loop"""
+        async def async_wrapper(query: str) -> str:
+            try:
+                # Get current context (this will be set by process_message)
+                context = _tool_context.get() or {}
+                result = await tool.execute(query, context)
+                return self._format_tool_result(result)
+
+            except Exception as e:
+                agent_logger.error(f"❌ Error in tool {tool.name}: {str(e)}")
+                return f"Error executing {tool.name}: {str(e)}"
+
+        return async_wrapper
+
     def _create_sync_wrapper(self, tool: AITool):
-        """Create a synchronous wrapper for async tools"""
+        """Create a synchronous wrapper for async tools (used by sync agent calls only)"""
         def sync_wrapper(query: str) -> str:
             try:
-                # Get current context (this will be set by process_message)
-                context = getattr(self, '_current_context', {})
-                
-                # Create event loop if needed
-                try:
-                    loop = asyncio.get_event_loop()
-                except RuntimeError:
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                
-                # Run the async tool
-                result = loop.run_until_complete(tool.execute(query, context))
-                
-                # Format result as string
-                if isinstance(result, dict):
-                    if 'error' in result:
-                        return f"Error: {result['error']}"
-                    elif 'answer' in result:
-                        return result['answer']
-                    else:
-                        return str(result)
-                return str(result)
-                
+                # Get current context (LangChain copies it into the worker thread)
+                context = _tool_context.get() or {}
+
+                if inspect.iscoroutinefunction(tool.execute):
+                    # LangChain runs sync tools in a worker thread, so hand the
+                    # coroutine back to the loop that is serving process_message
+                    future = asyncio.run_coroutine_threadsafe(
+                        tool.execute(query, context), self._loop
+                    )
+                    result = future.result(timeout=TOOL_TIMEOUT)
+                else:
+                    result = tool.execute(query, context)
+
+                return self._format_tool_result(result)
+
             except Exception as e:
                 agent_logger.error(f"❌ Error in tool {tool.name}: {str(e)}")
                 return f"Error executing {tool.name}: {str(e)}"
-        
+
         return sync_wrapper
     
     async def process_message(
@@ -130,31 +213,39 @@ class LangChainConversationAgent(ConversationAgent):
         message: str, 
         user_id: str, 
         context: Optional[Dict[str, Any]] = None,
-        user_name: str = "unknown"
+        user_name: str = "unknown",
+        on_token: Optional[Callable[[str], Awaitable[None]]] = None
     ) -> AIResponse:
-        """Process a user message and return an AI response"""
+        """Process a user message and return an AI response (optionally streaming answer tokens to on_token)"""
         agent_logger.info(f"🚀 Processing message for user {user_id}")
         agent_logger.debug(f"📝 Message: {message[:100]}...")
 
         # Log user query
         log_user_query(user_id, user_name, message)
 
+        # Set current context for tools
+        context_token = _tool_context.set({**(context or {}), 'user_id': user_id})
+
         try:
-            # Set current context for tools
-            self._current_context = context or {}
-            self._current_context['user_id'] = user_id
+            # Remember the running loop so tool threads can schedule coroutines on it
+            self._loop = asyncio.get_running_loop()
+
+            # Rebuild the agent once if tools changed since the last message
+            if self._tools_dirty:
+                self._setup_agent()
 
             # Detect language
-            detected_lang = detect_language(message)
+            detected_lang = _cached_detect_language(message)
             agent_logger.info(f"🌍 Detected language: {detected_lang}")
 
             # Normalize text if Turkish
             if detected_lang == 'tr':
-                message = normalize_text(message)
+                message = _cached_normalize_text(message)
                 agent_logger.debug("🔄 Applied Turkish text normalization")
 
-            # Get memory for user
+            # Get memory for user (rolling summary plus recent turns)
             memory = await self.memory_manager.get_memory(user_id)
+            memory_variables = await memory.aload_memory_variables({})
 
             # Build enhanced message with context
             enhanced_message = await self._build_enhanced_message(
@@ -162,10 +253,14 @@ class LangChainConversationAgent(ConversationAgent):
             )
 
             # Process with agent
-            agent_response = await self.agent.ainvoke({
+            agent_input = {
                 "input": enhanced_message,
-                "chat_history": memory.chat_memory.messages
-            })
+                "chat_history": memory_variables["chat_history"]
+            }
+            if on_token is None:
+                agent_response = await self.agent.ainvoke(agent_input)
+            else:
+                agent_response = await self._stream_agent(agent_input, on_token)
 
             response_content = agent_response.get("output", "")
 
@@ -194,6 +289,31 @@ class LangChainConversationAgent(ConversationAgent):
                 content="Sorry, I encountered an error while processing your message. Please try again.",
                 error=str(e)
             )
+        finally:
+            _tool_context.reset(context_token)
+    
+    async def _stream_agent(
+        self,
+        agent_input: Dict[str, Any],
+        on_token: Callable[[str], Awaitable[None]]
+    ) -> Dict[str, Any]:
+        """Run the agent, forwarding the model's text tokens as they arrive; returns the agent output"""
+        output: Dict[str, Any] = {}
+        tools_running = 0
+        async for event in self.agent.astream_events(agent_input, version="v2"):
+            kind = event["event"]
+            if kind == "on_tool_start":
+                tools_running += 1
+            elif kind == "on_tool_end":
+                tools_running -= 1
+            elif kind == "on_chat_model_stream" and not tools_running:
+                # Models called inside tools (e.g. document answers) are not the reply
+                chunk = event["data"]["chunk"]
+                if isinstance(chunk.content, str) and chunk.content:
+                    await on_token(chunk.content)
+            elif kind == "on_chain_end" and not event.get("parent_ids"):
+                output = event["data"].get("output") or {}
+        return output
     
     async def _build_enhanced_message(
         self, 
@@ -220,34 +340,24 @@ class LangChainConversationAgent(ConversationAgent):
             context_parts.append("")
         
         # Build the enhanced message
-        enhanced_message = f"""User Question: {message}
-
-Context:
-{chr(10).join(context_parts)}
-
-Instructions:
-1. Consider the previous conversation context when responding
-2. Provide a direct and natural response
-3. Don't mention that you're using tools or searching documents
-4. Keep the response concise and focused
-5. Use a conversational but professional tone
-6. Respond in {language} language
-7. If information isn't available, say so briefly
-"""
-        
-        return enhanced_message
+        return _ENHANCED_MESSAGE_TEMPLATE.format(
+            message=message,
+            context="\n".join(context_parts),
+            language=language
+        )
     
     def add_tool(self, tool: AITool) -> None:
         """Add a tool to the agent"""
-        self.tools[tool.name] = tool
-        self._setup_agent()  # Reinitialize agent with new tools
+        self._register_tool(tool)
+        self._tools_dirty = True  # Agent is rebuilt on the next message
         agent_logger.info(f"➕ Added tool: {tool.name}")
     
     def remove_tool(self, tool_name: str) -> bool:
         """Remove a tool by name"""
         if tool_name in self.tools:
             del self.tools[tool_name]
-            self._setup_agent()  # Reinitialize agent without the tool
+            del self._langchain_tools[tool_name]
+            self._tools_dirty = True  # Agent is rebuilt on the next message
             agent_logger.info(f"➖ Removed tool: {tool_name}")
             return True
         return False
@@ -6,7 +6,7 @@ easily extended with new tools and capabilities.
 """
 
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, ClassVar
 from dataclasses import dataclass
 
 
@@ -28,17 +28,10 @@ class AIResponse:
 class AITool(ABC):
     """Abstract base class for AI tools"""
     
-    @property
-    @abstractmethod
-    def name(self) -> str:
-        """Tool name"""
-        pass
+    __slots__ = ()
     
-    @property
-    @abstractmethod
-    def description(self) -> str:
-        """Tool description for the AI agent"""
-        pass
+    name: ClassVar[str]  # Tool name
+    description: ClassVar[str]  # Tool description for the AI agent
     
     @abstractmethod
     async def execute(self, query: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
@@ -0,0 +1,108 @@
+"""
+Cross-user scheduler for AI message processing.
+
+Each user's queue is drained by its own process_message_queue call; instead of
+every call starting its own LLM round-trip, ready batches are handed to a
+shared scheduler that gathers whatever arrived within a short window and runs
+it concurrently, with a semaphore bounding in-flight requests to the xAI API.
+"""
+
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Deque, Set, Tuple
+from collections import deque
+import asyncio
+
+from ..config import (
+    LLM_BATCH_WINDOW,
+    LLM_BATCH_MAX_SIZE,
+    LLM_MAX_CONCURRENCY,
+    SHORT_PROMPT_MAX_CHARS,
+    LONG_PROMPT_MIN_CHARS,
+    LONG_RESPONSE_KEYWORDS
+)
+from ..utils.logging import get_logger
+
+scheduler_logger = get_logger('batch_scheduler')
+
+_Entry = Tuple[str, List[Dict[str, Any]], Dict[str, Any], asyncio.Future]
+
+
+def predict_length_bin(text: str) -> str:
+    """Guess whether a prompt will get a short, medium or long answer"""
+    lowered = text.lower()
+    if len(text) >= LONG_PROMPT_MIN_CHARS or any(keyword in lowered for keyword in LONG_RESPONSE_KEYWORDS):
+        return "long"
+    if len(text) <= SHORT_PROMPT_MAX_CHARS and text.count("?") <= 1:
+        return "short"
+    return "medium"
+
+
+class BatchScheduler:
+    """
+    Groups ready user batches and processes them concurrently
+
+    Callers await submit(user_id, messages); a background task collects pending
+    entries every window seconds (up to max_batch at a time) and starts them
+    together, while the semaphore caps how many are in flight overall. Each
+    caller is answered as soon as its own request completes.
+    """
+
+    def __init__(
+        self,
+        process: Callable[..., Awaitable[Any]],
+        window: float = LLM_BATCH_WINDOW,
+        max_batch: int = LLM_BATCH_MAX_SIZE,
+        max_concurrency: int = LLM_MAX_CONCURRENCY
+    ):
+        self.process = process
+        self.window = window
+        self.max_batch = max_batch
+        self.max_concurrency = max_concurrency
+        self._pending: Deque[_Entry] = deque()
+        self._worker: Optional[asyncio.Task] = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._running: Set[asyncio.Task] = set()
+
+    async def submit(self, user_id: str, messages: List[Dict[str, Any]], **options: Any) -> Any:
+        """Queue a user's messages and wait for process's result (options are passed through to process)"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((user_id, messages, options, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await future
+
+    def _next_batch(self) -> List[_Entry]:
+        batch = []
+        while self._pending and len(batch) < self.max_batch:
+            batch.append(self._pending.popleft())
+        return batch
+
+    async def _run(self):
+        while self._pending:
+            # Let other users' batches join unless a full batch is already waiting
+            if len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.window)
+
+            batch = self._next_batch()
+            scheduler_logger.debug(f"📦 Dispatching {len(batch)} user batches")
+            # One task per entry, each resolving its own caller as soon as it finishes,
+            # so nobody waits for the slowest request dispatched alongside them
+            for user_id, messages, options, future in batch:
+                task = asyncio.create_task(self._process_one(user_id, messages, options))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                task.add_done_callback(lambda task, future=future: self._resolve(future, task))
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, task: asyncio.Task) -> None:
+        if future.done():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    async def _process_one(self, user_id: str, messages: List[Dict[str, Any]], options: Dict[str, Any]) -> Any:
+        async with self._semaphore:
+            return await self.process(messages, user_id, **options)
@@ -6,8 +6,20 @@ for different users and sessions.
 """
 
 from typing import Dict, Any, Optional
-from langchain.memory import ConversationBufferMemory
+from collections import deque
+import asyncio
+import weakref
+from cachetools import TTLCache
+from langchain_core.language_models import BaseChatModel
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain_core.messages import HumanMessage, AIMessage
 from .base import MemoryManager
+from ..config import (
+    MEMORY_CACHE_SIZE,
+    MEMORY_CACHE_TTL,
+    MEMORY_MAX_TOKEN_LIMIT,
+    RECENT_HISTORY_SIZE
+)
 from ..database.mongodb import db
 from ..utils.logging import get_logger
 
@@ -18,30 +30,58 @@ memory_logger = get_logger('ai_memory')
 class LangChainMemoryManager(MemoryManager):
     """LangChain-based memory manager for conversation history"""
     
-    def __init__(self):
-        self.memories: Dict[str, ConversationBufferMemory] = {}
+    def __init__(self, llm: Optional[BaseChatModel] = None):
+        # Summarizes older turns once a buffer exceeds MEMORY_MAX_TOKEN_LIMIT.
+        # The conversation agent injects its shared client at startup.
+        self.llm = llm
+        # Idle users are evicted and re-hydrated from MongoDB on their next message
+        self.memories: TTLCache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=MEMORY_CACHE_TTL)
+        # Last few formatted lines per user, so prompts don't re-walk the full buffer
+        self._recent_history: TTLCache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=MEMORY_CACHE_TTL)
+        # Per-user hydration locks; entries disappear once no coroutine holds them
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
         self.db = db
     
-    async def get_memory(self, user_id: str) -> ConversationBufferMemory:
+    async def get_memory(self, user_id: str) -> ConversationSummaryBufferMemory:
         """Get or create memory for a user"""
-        if user_id not in self.memories:
-            memory_logger.debug(f"🧠 Creating new memory for user {user_id}")
-            self.memories[user_id] = ConversationBufferMemory(
-                return_messages=True,
-                input_key="input",
-                output_key="output"
-            )
-            
-            # Load recent conversation history from database
-            await self._load_history_from_db(user_id)
+        memory = self.memories.get(user_id)
+        if memory is not None:
+            return memory
         
-        return self.memories[user_id]
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        
+        # Serialize hydration per user so back-to-back messages load history once
+        async with lock:
+            memory = self.memories.get(user_id)
+            if memory is None:
+                memory_logger.debug(f"🧠 Creating new memory for user {user_id}")
+                memory = ConversationSummaryBufferMemory(
+                    llm=self.llm,
+                    max_token_limit=MEMORY_MAX_TOKEN_LIMIT,
+                    return_messages=True,
+                    memory_key="chat_history",
+                    input_key="input",
+                    output_key="output"
+                )
+                self.memories[user_id] = memory
+                
+                # Load recent conversation history from database
+                await self._load_history_from_db(user_id, memory)
+                # clear_memory or a cache eviction may have dropped it during the load
+                self.memories[user_id] = memory
+            
+            return memory
     
     async def update_memory(self, user_id: str, message: str, response: str) -> None:
         """Update memory with new conversation"""
         memory = await self.get_memory(user_id)
-        memory.chat_memory.add_user_message(message)
-        memory.chat_memory.add_ai_message(response)
+        # save_context prunes the buffer and summarizes turns over the token limit
+        await memory.asave_context({"input": message}, {"output": response})
+        self._remember_turn(user_id, message, response)
+        # Re-insert to refresh the user's TTL on activity
+        self.memories[user_id] = memory
         
         memory_logger.debug(f"💭 Updated memory for user {user_id}")
     
@@ -49,46 +89,69 @@ class LangChainMemoryManager(MemoryManager):
         """Clear memory for a user"""
         if user_id in self.memories:
             self.memories[user_id].clear()
+            self._recent_history.pop(user_id, None)
             memory_logger.info(f"🗑️ Cleared memory for user {user_id}")
     
-    async def _load_history_from_db(self, user_id: str) -> None:
-        """Load recent conversation history from database"""
+    async def _load_history_from_db(self, user_id: str, memory: ConversationSummaryBufferMemory) -> None:
+        """Load recent conversation history from database into a user's new memory"""
         try:
-            recent_messages = list(self.db.message_queue.find(
-                {
-                    "user_id": user_id,
-                    "is_processed": True,
-                    "response": {"$exists": True}
-                }
-            ).sort("timestamp", -1).limit(5))
-            
-            memory = self.memories[user_id]
+            # PyMongo is blocking, so run the query off the event loop
+            recent_messages = await asyncio.to_thread(
+                lambda: list(self.db.message_queue.find(
+                    {
+                        "user_id": user_id,
+                        "is_processed": True,
+                        "response": {"$exists": True}
+                    },
+                    projection={"message": 1, "response": 1, "_id": 0}
+                ).sort("timestamp", -1).limit(5))
+            )
             
             # Add messages to memory in chronological order
             for msg in reversed(recent_messages):
-                memory.chat_memory.add_user_message(msg['message'])
                 if msg.get('response'):
-                    memory.chat_memory.add_ai_message(msg['response'])
+                    await memory.asave_context(
+                        {"input": msg['message']},
+                        {"output": msg['response']}
+                    )
+                else:
+                    memory.chat_memory.add_user_message(msg['message'])
+                self._remember_turn(user_id, msg['message'], msg.get('response'))
             
             memory_logger.debug(f"📚 Loaded {len(recent_messages)} messages from DB for user {user_id}")
             
         except Exception as e:
             memory_logger.error(f"❌ Failed to load history for user {user_id}: {str(e)}")
     
+    def _remember_turn(self, user_id: str, message: str, response: Optional[str]) -> None:
+        """Append a turn to the user's bounded recent-history window"""
+        recent = self._recent_history.get(user_id)
+        if recent is None:
+            recent = deque(maxlen=RECENT_HISTORY_SIZE)
+        recent.append(f"User: {message}")
+        if response:
+            recent.append(f"Assistant: {response}")
+        # Re-insert to refresh the TTL alongside the user's memory
+        self._recent_history[user_id] = recent
+    
     def get_conversation_history(self, user_id: str) -> list[str]:
         """Get formatted conversation history for a user"""
+        recent = self._recent_history.get(user_id)
+        if recent is not None:
+            return list(recent)
+        
         if user_id not in self.memories:
             return []
         
+        # Fall back to the buffer if the window was evicted before the memory
         memory = self.memories[user_id]
         history = []
         
-        for message in memory.chat_memory.messages:
-            if hasattr(message, 'content'):
-                if message.__class__.__name__ == 'HumanMessage':
-                    history.append(f"User: {message.content}")
-                elif message.__class__.__name__ == 'AIMessage':
-                    history.append(f"Assistant: {message.content}")
+        for message in memory.chat_memory.messages[-RECENT_HISTORY_SIZE:]:
+            if isinstance(message, HumanMessage):
+                history.append(f"User: {message.content}")
+            elif isinstance(message, AIMessage):
+                history.append(f"Assistant: {message.content}")
         
         return history
 
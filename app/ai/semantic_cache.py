@@ -0,0 +1,97 @@
+"""
+Semantic caches for AI answers.
+
+Answers are kept per user and matched either by the exact question or by the
+cosine similarity of its embedding, so a repeated or rephrased question can be
+answered without retrieval or an LLM call. Entries are also keyed by the
+conversation's last turn, so the same words after a different exchange miss.
+"""
+
+from typing import Any, Optional, Sequence, Tuple
+from collections import deque
+import hashlib
+import numpy as np
+from cachetools import TTLCache
+
+from ..config import (
+    MEMORY_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_SIMILARITY,
+    RESPONSE_CACHE_PER_USER,
+    RESPONSE_CACHE_MIN_CHARS,
+    RESPONSE_CACHE_FOLLOW_UP_PREFIXES
+)
+
+
+def quantize_int8(vector: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Scale a vector into int8 codes; returns (codes, scale) with vector ≈ codes * scale"""
+    peak = float(np.abs(vector).max()) if vector.size else 0.0
+    scale = peak / 127 if peak else 1.0
+    return np.round(vector / scale).astype(np.int8), scale
+
+
+class SemanticCache:
+    """Per-user cache of answers, matched by exact question or by embedding similarity"""
+
+    def __init__(self, threshold: float, ttl: int, entries_per_user: int, maxsize: int):
+        self.threshold = threshold
+        self.entries_per_user = entries_per_user
+        self._exact: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)  # (user_id, context, query) -> answer
+        self._similar: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)  # user_id -> deque of (int8 codes, scale, context, answer)
+
+    @staticmethod
+    def unit_vector(embedding) -> np.ndarray:
+        """Normalize an embedding so cosine similarity is a dot product"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def accepts(query: str) -> bool:
+        """Whether a message stands on its own; short or follow-up messages depend on the conversation"""
+        text = query.strip().lower()
+        return len(text) >= RESPONSE_CACHE_MIN_CHARS and not text.startswith(RESPONSE_CACHE_FOLLOW_UP_PREFIXES)
+
+    @staticmethod
+    def context_key(turns: Sequence[str]) -> str:
+        """Fingerprint of the conversation turns an answer was given after"""
+        return hashlib.blake2b("\n".join(turns).encode("utf-8"), digest_size=8).hexdigest()
+
+    def get_exact(self, user_id: str, query: str, context: str = "") -> Optional[Any]:
+        """Answer cached for this exact question after the same last turn, if any"""
+        return self._exact.get((user_id, context, query))
+
+    def get_similar(self, user_id: str, vector: np.ndarray, context: str = "") -> Optional[Any]:
+        """Answer to the most similar recent question (after the same last turn) above the threshold, if any"""
+        entries = [entry for entry in self._similar.get(user_id, ()) if entry[2] == context]
+        if not entries:
+            return None
+        codes = np.stack([cached for cached, _, _, _ in entries]).astype(np.float32)
+        scores = (codes @ vector) * np.array([scale for _, scale, _, _ in entries], dtype=np.float32)
+        best = int(np.argmax(scores))
+        return entries[best][3] if scores[best] >= self.threshold else None
+
+    def put(self, user_id: str, query: str, vector: np.ndarray, answer: Any, context: str = "") -> None:
+        """Remember an answer under both the exact question and its embedding"""
+        self._exact[(user_id, context, query)] = answer
+        entries = self._similar.get(user_id)
+        if entries is None:
+            entries = deque(maxlen=self.entries_per_user)
+        # int8 codes take a quarter of the float32 memory
+        entries.append((*quantize_int8(vector), context, answer))
+        self._similar[user_id] = entries  # re-insert to refresh the TTL
+
+    def invalidate(self, user_id: str) -> None:
+        """Drop a user's cached answers (their documents changed)"""
+        self._similar.pop(user_id, None)
+        for key in [key for key in self._exact if key[0] == user_id]:
+            self._exact.pop(key, None)
+
+
+# Full replies to a user's combined message; checked before retrieval and the agent
+response_cache = SemanticCache(
+    threshold=RESPONSE_CACHE_SIMILARITY,
+    ttl=RESPONSE_CACHE_TTL,
+    entries_per_user=RESPONSE_CACHE_PER_USER,
+    maxsize=MEMORY_CACHE_SIZE
+)
@@ -5,17 +5,33 @@ This service acts as a bridge between the Telegram handlers and the AI system,
 providing a clean interface for message processing.
 """
 
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Set, Tuple, Callable, Awaitable
 from datetime import datetime
+import asyncio
+from cachetools import TTLCache
 from .agent import conversation_agent
 from .base import AIResponse
+from .tools import invalidate_document_answers
+from .semantic_cache import SemanticCache, response_cache
+from ..config import MEMORY_CACHE_SIZE, USER_DOCS_CACHE_TTL, AVAILABLE_DOCS_CACHE_TTL
 from ..database.mongodb import db
 from ..utils.logging import get_logger
 from ..handlers.document import document_handler
+from ..services.embedding import embedding_service
 
 # Setup logger
 service_logger = get_logger('ai_service')
 
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _on_background_task_done(task: asyncio.Task) -> None:
+    """Drop the task reference and surface any unexpected failure"""
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        service_logger.error(f"❌ Background task failed: {task.exception()}")
+
 
 class AIMessageService:
     """Service for processing messages with AI agents"""
@@ -23,6 +39,10 @@ class AIMessageService:
     def __init__(self):
         self.agent = conversation_agent
         self.db = db
+        # Remembers users with no documents so their messages skip the lookup
+        self._user_has_docs: TTLCache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=USER_DOCS_CACHE_TTL)
+        # Formatted document listings; doc lists rarely change between turns
+        self._available_docs: TTLCache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=AVAILABLE_DOCS_CACHE_TTL)
     
     async def process_user_messages(
         self, 
@@ -30,13 +50,57 @@ class AIMessageService:
         user_id: str
     ) -> str:
         """Process a batch of user messages and return response"""
+        response, history = await self.process_user_batch(messages, user_id)
+        
+        # Update database with conversation info without delaying the reply
+        if history is not None and messages:
+            task = asyncio.create_task(self._update_conversation_history(messages[-1]["_id"], history))
+            _background_tasks.add(task)
+            task.add_done_callback(_on_background_task_done)
+        
+        return response
+    
+    async def process_user_batch(
+        self, 
+        messages: List[Dict[str, Any]], 
+        user_id: str,
+        on_token: Optional[Callable[[str], Awaitable[None]]] = None
+    ) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Process a batch of user messages without writing to the database
+        
+        Returns the response and the conversation_history record for the batch's
+        last message (None for errors), so callers can store it together with
+        the response. When on_token is given, the agent's answer
+        is also streamed to it as it is generated.
+        """
         service_logger.info(f"🚀 Processing {len(messages)} messages for user {user_id}")
         
         try:
             # Combine messages
-            combined_message = " ".join([msg["message"] for msg in messages])
+            combined_message = " ".join(msg["message"] for msg in messages)
             service_logger.debug(f"📝 Combined message: {combined_message[:200]}...")
             
+            # Same or a similar message answered recently after the same last turn: skip
+            # retrieval and the agent. Short and follow-up messages depend on the conversation
+            cacheable = response_cache.accepts(combined_message)
+            cached = None
+            if cacheable:
+                memory_manager = self.agent.memory_manager
+                await memory_manager.get_memory(user_id)  # loads stored history on first use
+                cache_context = SemanticCache.context_key(memory_manager.get_conversation_history(user_id)[-2:])
+                cached = response_cache.get_exact(user_id, combined_message, cache_context)
+                if cached is None:
+                    message_vector = SemanticCache.unit_vector(await embedding_service.embed_query(combined_message))
+                    cached = response_cache.get_similar(user_id, message_vector, cache_context)
+            if cached is not None:
+                service_logger.info(f"♻️ Reusing cached response for user {user_id}")
+                # The turn still happened: keep memory and the stored history complete
+                await memory_manager.update_memory(user_id, combined_message, cached)
+                return cached, self._conversation_history_record(
+                    AIResponse(content=cached, metadata={"cached": True}), {}, combined_message
+                )
+            
             # Get document context
             doc_context = await self._get_document_context(combined_message, user_id)
             
@@ -53,57 +117,64 @@ class AIMessageService:
             ai_response = await self.agent.process_message(
                 combined_message, 
                 user_id, 
-                context
+                context,
+                on_token=on_token
             )
             
-            # Update database with conversation info
-            await self._update_conversation_history(messages, ai_response, doc_context)
+            if cacheable and ai_response.error is None:
+                response_cache.put(user_id, combined_message, message_vector, ai_response.content, cache_context)
             
             service_logger.info(f"✅ Successfully processed messages for user {user_id}")
-            return ai_response.content
+            return ai_response.content, self._conversation_history_record(
+                ai_response, doc_context, combined_message
+            )
             
         except Exception as e:
             service_logger.error(f"❌ Error processing messages: {str(e)}")
-            return "Sorry, I couldn't process your message. Please try again."
+            return "Sorry, I couldn't process your message. Please try again.", None
     
     async def _get_document_context(self, query: str, user_id: str) -> Dict[str, Any]:
         """Get relevant context from user's documents"""
         try:
+            if self._user_has_docs.get(user_id) is False:
+                return {"context": "", "sources": [], "available_docs": []}
+            
             # Get user's documents from MongoDB
-            user_docs = self.db.get_user_documents(user_id)
+            user_docs = await asyncio.to_thread(self.db.get_user_documents, user_id)
+            self._user_has_docs[user_id] = bool(user_docs)
             if not user_docs:
                 return {"context": "", "sources": [], "available_docs": []}
 
-            # Format available documents info
-            available_docs = []
-            for doc in user_docs:
-                metadata = doc.get('metadata', {})
-                file_name = metadata.get('file_name', '')
-                upload_time = doc.get('upload_time', datetime.utcnow()).strftime('%Y-%m-%d %H:%M')
-                status = "✅" if doc.get('status') == "processed" else "❌"
-                available_docs.append(f"- {status} {file_name} (Uploaded: {upload_time})")
-
             # Query documents with multiple variations for better results
-            semantic_variations = [
+            # (dict.fromkeys drops duplicates such as a query without "?")
+            semantic_variations = list(dict.fromkeys([
                 query,  # Original query
                 f"find information about {query}",
                 f"what does the document say about {query}",
                 query.replace("?", "").strip()  # Clean query
-            ]
+            ]))
             
-            all_responses = []
-            for variation in semantic_variations:
-                response = await document_handler.query_documents(variation, user_id, k=5)
-                if response and response.get("answer"):
-                    all_responses.append(response)
+            # Run the variations concurrently rather than one after another
+            responses = await asyncio.gather(*(
+                document_handler.query_documents(variation, user_id, k=5)
+                for variation in semantic_variations
+            ))
+            all_responses = [
+                response for response in responses
+                if response and response.get("answer")
+            ]
 
             # Build context
             context_parts = []
             
-            # Add available documents list
-            context_parts.append("Your available documents:")
-            context_parts.extend(available_docs)
-            context_parts.append("")  # Empty line for separation
+            # List available documents only when retrieval found nothing,
+            # so the model can point the user at what they have uploaded
+            available_docs = []
+            if not all_responses:
+                available_docs = self._format_available_docs(user_id, user_docs)
+                context_parts.append("Your available documents:")
+                context_parts.extend(available_docs)
+                context_parts.append("")  # Empty line for separation
 
             # Add query-specific content if available
             for response in all_responses:
@@ -112,11 +183,17 @@ class AIMessageService:
                     context_parts.append(response["answer"])
                     context_parts.append("")
 
-            # Combine all sources
+            # Combine all sources, keeping each chunk only once
             all_sources = []
+            seen_chunk_ids = set()
             for response in all_responses:
-                if response.get("sources"):
-                    all_sources.extend(response["sources"])
+                for source in response.get("sources") or []:
+                    chunk_id = source.get("metadata", {}).get("chunk_id")
+                    if chunk_id is not None:
+                        if chunk_id in seen_chunk_ids:
+                            continue
+                        seen_chunk_ids.add(chunk_id)
+                    all_sources.append(source)
 
             return {
                 "context": "\n".join(context_parts),
@@ -133,40 +210,50 @@ class AIMessageService:
             service_logger.error(f"❌ Error getting document context: {str(e)}")
             return {"context": "", "sources": [], "available_docs": [], "stats": {}}
     
-    async def _update_conversation_history(
-        self, 
-        messages: List[Dict[str, Any]], 
+    def _format_available_docs(self, user_id: str, user_docs: List[Dict[str, Any]]) -> List[str]:
+        """Format (and briefly cache) the user's document listing"""
+        available_docs = self._available_docs.get(user_id)
+        if available_docs is None:
+            available_docs = []
+            for doc in user_docs:
+                metadata = doc.get('metadata', {})
+                file_name = metadata.get('file_name', '')
+                upload_time = doc.get('upload_time', datetime.utcnow()).strftime('%Y-%m-%d %H:%M')
+                status = "✅" if doc.get('status') == "processed" else "❌"
+                available_docs.append(f"- {status} {file_name} (Uploaded: {upload_time})")
+            self._available_docs[user_id] = available_docs
+        return available_docs
+    
+    @staticmethod
+    def _conversation_history_record(
         ai_response: AIResponse, 
-        doc_context: Dict[str, Any]
-    ) -> None:
+        doc_context: Dict[str, Any],
+        combined_message: str
+    ) -> Dict[str, Any]:
+        """Build the conversation_history stored on a batch's last message"""
+        return {
+            "user_message": combined_message,
+            "assistant_response": ai_response.content,
+            "language": ai_response.metadata.get('language', 'unknown'),
+            "document_context_used": bool(doc_context.get('sources')),
+            "documents_referenced": [
+                source["metadata"]["file_name"]
+                for source in doc_context.get("sources", [])
+                if isinstance(source, dict) and source.get("metadata", {}).get("file_name")
+            ],
+            "stats": doc_context.get('stats', {}),
+            "cached": ai_response.metadata.get('cached', False),
+            "timestamp": datetime.utcnow(),
+            "error": ai_response.error
+        }
+    
+    async def _update_conversation_history(self, message_id: Any, history: Dict[str, Any]) -> None:
         """Update conversation history in database"""
         try:
-            if not messages:
-                return
-            
-            combined_message = " ".join([msg["message"] for msg in messages])
-            
             # Update the last message with conversation history
-            self.db.message_queue.update_one(
-                {"_id": messages[-1]["_id"]},
-                {
-                    "$set": {
-                        "conversation_history": {
-                            "user_message": combined_message,
-                            "assistant_response": ai_response.content,
-                            "language": ai_response.metadata.get('language', 'unknown'),
-                            "document_context_used": bool(doc_context.get('sources')),
-                            "documents_referenced": [
-                                source["metadata"]["file_name"]
-                                for source in doc_context.get("sources", [])
-                                if isinstance(source, dict) and source.get("metadata", {}).get("file_name")
-                            ],
-                            "stats": doc_context.get('stats', {}),
-                            "timestamp": datetime.utcnow(),
-                            "error": ai_response.error
-                        }
-                    }
-                }
+            await self.db.async_message_queue.update_one(
+                {"_id": message_id},
+                {"$set": {"conversation_history": history}}
             )
             
             service_logger.debug("📊 Updated conversation history in database")
@@ -174,6 +261,13 @@ class AIMessageService:
         except Exception as e:
             service_logger.error(f"❌ Error updating conversation history: {str(e)}")
     
+    def invalidate_user_documents(self, user_id: str) -> None:
+        """Forget cached document state for a user (e.g. after an upload)"""
+        self._user_has_docs.pop(user_id, None)
+        self._available_docs.pop(user_id, None)
+        invalidate_document_answers(user_id)
+        response_cache.invalidate(user_id)
+    
     def add_tool_to_agent(self, tool_name: str) -> bool:
         """Add a tool to the conversation agent"""
         from .tools import create_tool
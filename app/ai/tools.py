@@ -8,22 +8,76 @@ by various agents in the system.
 from typing import Dict, Any, Optional
 import asyncio
 import re
+import weakref
+from functools import lru_cache
+from cachetools import TTLCache
 from .base import AITool
+from .semantic_cache import SemanticCache
+from ..config import (
+    MEMORY_CACHE_SIZE,
+    HISTORY_TOOL_CACHE_TTL,
+    DOCUMENT_ANSWER_CACHE_TTL,
+    DOCUMENT_ANSWER_SIMILARITY,
+    DOCUMENT_ANSWER_CACHE_PER_USER
+)
 from ..handlers.document import document_handler
+from ..services.embedding import embedding_service
 from ..handlers.youtube import youtube_handler
 from ..utils.language import detect_language
 
+try:
+    # google-re2 guarantees linear-time matching on long user messages
+    import re2 as _re_engine
+except ImportError:
+    _re_engine = re
+
+# Compiled once at import; matched against every query routed to the YouTube tool
+_YOUTUBE_URL_RE = _re_engine.compile(
+    r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/)([^&\n?#]+)'
+)
+
+
+# Short-lived per-user cache of history lookups; repeated tool calls within a turn
+# reuse the last result instead of querying MongoDB again
+_history_cache: TTLCache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=HISTORY_TOOL_CACHE_TTL)
+_history_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+_document_answers = SemanticCache(
+    threshold=DOCUMENT_ANSWER_SIMILARITY,
+    ttl=DOCUMENT_ANSWER_CACHE_TTL,
+    entries_per_user=DOCUMENT_ANSWER_CACHE_PER_USER,
+    maxsize=MEMORY_CACHE_SIZE
+)
+
+
+def invalidate_document_answers(user_id: str) -> None:
+    """Forget cached document answers for a user (e.g. after an upload)"""
+    _document_answers.invalidate(user_id)
+
+
+@lru_cache(maxsize=10_000)
+def _cached_detect(text: str) -> str:
+    """Memoized detect_language; greetings and short commands repeat often"""
+    return detect_language(text)
+
+
+def _search_youtube_url(query: str):
+    """Return the first YouTube URL match in the query, or None"""
+    return _YOUTUBE_URL_RE.search(query)
+
+
+# One line per retrieved chunk in DocumentQueryTool results
+_SOURCE_TEMPLATE = "From {file_name}: {excerpt}..."
+
 
 class DocumentQueryTool(AITool):
     """Tool for querying user documents"""
     
-    @property
-    def name(self) -> str:
-        return "Document Query"
+    __slots__ = ()
     
-    @property
-    def description(self) -> str:
-        return "Search for information in user's documents. Use this when the user asks about their uploaded documents or files."
+    name: str = "Document Query"
+    description: str = "Search for information in user's documents. Use this when the user asks about their uploaded documents or files."
     
     async def execute(self, query: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Execute document query"""
@@ -33,24 +87,41 @@ class DocumentQueryTool(AITool):
             
             user_id = context['user_id']
             
+            # Same question asked again: skip embedding, retrieval and generation
+            cached = _document_answers.get_exact(user_id, query)
+            if cached is not None:
+                return cached
+            
+            # Rephrased question: reuse the answer to a sufficiently similar one
+            query_vector = SemanticCache.unit_vector(await embedding_service.embed_query(query))
+            cached = _document_answers.get_similar(user_id, query_vector)
+            if cached is not None:
+                return cached
+            
             # Use existing document handler logic
             result = await document_handler.query_documents(query, user_id)
             
+            if not isinstance(result, dict):
+                return {"answer": "No results found", "sources": []}
+            
             # Format the result for better readability
-            if isinstance(result, dict):
-                formatted_result = {
-                    "answer": result.get("answer", "No relevant information found."),
-                    "sources": [
-                        f"From {s['metadata'].get('file_name', 'Unknown')}: {s['content'][:200]}..."
-                        for s in result.get("sources", [])
-                    ],
-                    "metadata": {
-                        "total_docs": result.get("total_docs", 0),
-                        "docs_used": result.get("docs_used", 0)
-                    }
+            source_template = _SOURCE_TEMPLATE.format
+            sources = [
+                source_template(file_name=s['metadata'].get('file_name', 'Unknown'), excerpt=s['content'][:200])
+                for s in result.get("sources") or ()
+            ]
+            formatted_result = {
+                "answer": result.get("answer", "No relevant information found."),
+                "sources": sources,
+                "metadata": {
+                    "total_docs": result.get("total_docs", 0),
+                    "docs_used": result.get("docs_used", 0)
                 }
-                return formatted_result
-            return {"answer": "No results found", "sources": []}
+            }
+            # Only answers grounded in retrieved content are worth reusing
+            if sources:
+                _document_answers.put(user_id, query, query_vector, formatted_result)
+            return formatted_result
             
         except Exception as e:
             return {"error": f"Error querying documents: {str(e)}"}
@@ -59,18 +130,16 @@ class DocumentQueryTool(AITool):
 class LanguageDetectionTool(AITool):
     """Tool for detecting message language"""
     
-    @property
-    def name(self) -> str:
-        return "Language Detection"
+    __slots__ = ()
     
-    @property
-    def description(self) -> str:
-        return "Detect the language of user messages. Use this to understand what language the user is communicating in."
+    name: str = "Language Detection"
+    description: str = "Detect the language of user messages. Use this to understand what language the user is communicating in."
     
     async def execute(self, query: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Execute language detection"""
         try:
-            detected_lang = detect_language(query)
+            # The first 256 characters are enough to identify the language and cap the key size
+            detected_lang = _cached_detect(query[:256])
             return {
                 "language": detected_lang,
                 "original_text": query
@@ -82,13 +151,10 @@ class LanguageDetectionTool(AITool):
 class ConversationHistoryTool(AITool):
     """Tool for retrieving conversation history"""
     
-    @property
-    def name(self) -> str:
-        return "Conversation History"
+    __slots__ = ()
     
-    @property
-    def description(self) -> str:
-        return "Retrieve previous conversation history with the user. Use this to maintain context across conversations."
+    name: str = "Conversation History"
+    description: str = "Retrieve previous conversation history with the user. Use this to maintain context across conversations."
     
     async def execute(self, query: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Execute conversation history retrieval"""
@@ -99,28 +165,49 @@ class ConversationHistoryTool(AITool):
             user_id = context['user_id']
             db = context['db']
             
-            # Get recent messages from MongoDB
-            recent_messages = list(db.message_queue.find(
-                {
-                    "user_id": user_id,
-                    "is_processed": True,
-                    "response": {"$exists": True}
-                }
-            ).sort("timestamp", -1).limit(5))
+            cached = _history_cache.get(user_id)
+            if cached is not None:
+                return cached
             
-            # Format conversation history
-            history = []
-            for msg in reversed(recent_messages):
-                history.append({
-                    "user": msg['message'],
-                    "assistant": msg.get('response', ''),
-                    "timestamp": msg.get('timestamp')
-                })
+            lock = _history_locks.get(user_id)
+            if lock is None:
+                lock = _history_locks[user_id] = asyncio.Lock()
             
-            return {
-                "history": history,
-                "count": len(history)
-            }
+            async with lock:
+                cached = _history_cache.get(user_id)
+                if cached is not None:
+                    return cached
+                
+                # Get the 5 most recent exchanges from MongoDB, returned oldest first;
+                # the newest-first stage is served by message_user_processed_timestamp_index
+                cursor = await db.async_message_queue.aggregate([
+                    {"$match": {
+                        "user_id": user_id,
+                        "is_processed": True,
+                        "response": {"$exists": True}
+                    }},
+                    {"$sort": {"timestamp": -1}},
+                    {"$limit": 5},
+                    {"$sort": {"timestamp": 1}},
+                    {"$project": {"message": 1, "response": 1, "timestamp": 1}}
+                ])
+                recent_messages = await cursor.to_list(5)
+                
+                # Format conversation history
+                history = []
+                for msg in recent_messages:
+                    history.append({
+                        "user": msg['message'],
+                        "assistant": msg.get('response', ''),
+                        "timestamp": msg.get('timestamp')
+                    })
+                
+                result = {
+                    "history": history,
+                    "count": len(history)
+                }
+                _history_cache[user_id] = result
+                return result
             
         except Exception as e:
             return {"error": f"Error retrieving conversation history: {str(e)}"}
@@ -129,15 +216,12 @@ class ConversationHistoryTool(AITool):
 class YouTubeTranscriptTool(AITool):
     """Tool for processing YouTube video transcripts and searching them"""
     
-    @property
-    def name(self) -> str:
-        return "YouTube Transcript"
+    __slots__ = ()
     
-    @property 
-    def description(self) -> str:
-        return ("Process YouTube video transcripts and search them for relevant content. "
-                "Use this when the user provides a YouTube URL or asks about YouTube video content. "
-                "Can extract, store, and search video transcripts to answer questions about video content.")
+    name: str = "YouTube Transcript"
+    description: str = ("Process YouTube video transcripts and search them for relevant content. "
+                        "Use this when the user provides a YouTube URL or asks about YouTube video content. "
+                        "Can extract, store, and search video transcripts to answer questions about video content.")
     
     async def execute(self, query: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Execute YouTube transcript processing or search"""
@@ -148,8 +232,7 @@ class YouTubeTranscriptTool(AITool):
             user_id = context['user_id']
             
             # Check if query contains a YouTube URL
-            youtube_url_pattern = r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/)([^&\n?#]+)'
-            url_match = re.search(youtube_url_pattern, query)
+            url_match = _search_youtube_url(query)
             
             if url_match:
                 # Process YouTube URL
@@ -162,15 +245,17 @@ class YouTubeTranscriptTool(AITool):
                 if "error" in result:
                     return result
                 
+                title = result.get('title')
+                chunks_count = result.get('chunks_count', 0)
                 return {
                     "action": "video_processed",
-                    "message": f"✅ Successfully processed YouTube video: {result.get('title', 'Unknown')}",
+                    "message": f"✅ Successfully processed YouTube video: {title if title is not None else 'Unknown'}",
                     "video_info": {
-                        "title": result.get('title'),
+                        "title": title,
                         "video_id": result.get('video_id'),
-                        "chunks_count": result.get('chunks_count', 0)
+                        "chunks_count": chunks_count
                     },
-                    "sources": [f"Processed YouTube video transcript with {result.get('chunks_count', 0)} chunks"]
+                    "sources": [f"Processed YouTube video transcript with {chunks_count} chunks"]
                 }
             else:
                 # Search existing transcripts
@@ -179,7 +264,7 @@ class YouTubeTranscriptTool(AITool):
                 if "error" in search_result:
                     return search_result
                 
-                results = search_result.get('results', [])
+                results = search_result.get('results') or []
                 if not results:
                     return {
                         "action": "search_completed",
@@ -192,8 +277,11 @@ class YouTubeTranscriptTool(AITool):
                 sources = []
                 
                 for result in results:
-                    answer_parts.append(f"From '{result['title']}' at {result['timestamp']}: {result['text']}")
-                    sources.append(result['context'])
+                    title, timestamp, text, source = (
+                        result['title'], result['timestamp'], result['text'], result['context']
+                    )
+                    answer_parts.append(f"From '{title}' at {timestamp}: {text}")
+                    sources.append(source)
                 
                 return {
                     "action": "search_completed", 
@@ -218,12 +306,13 @@ AVAILABLE_TOOLS = {
 }
 
 
+# Tools are stateless, so one shared instance per tool serves every caller
+_TOOL_INSTANCES: Dict[str, AITool] = {name: cls() for name, cls in AVAILABLE_TOOLS.items()}
+
+
 def create_tool(tool_name: str) -> Optional[AITool]:
-    """Factory function to create tools by name"""
-    tool_class = AVAILABLE_TOOLS.get(tool_name)
-    if tool_class:
-        return tool_class()
-    return None
+    """Factory function to get tools by name"""
+    return _TOOL_INSTANCES.get(tool_name)
 
 
 def get_available_tool_names() -> list[str]:
@@ -1,8 +1,10 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv()
+# Load environment variables (container deployments inject them directly)
+if not os.getenv("DOCEXPERT_SKIP_DOTENV"):
+    load_dotenv()
 
 # Bot Configuration
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -13,6 +15,9 @@ HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
 EMBEDDING_SERVICE = os.getenv("EMBEDDING_SERVICE", "huggingface")  # Options: "huggingface", "local"
 EMBEDDING_MODEL = "intfloat/multilingual-e5-large"  # HuggingFace model that supports feature extraction (1024 dimensions)
 EMBEDDING_BATCH_SIZE = 50  # HuggingFace allows batch processing
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", EMBEDDING_BATCH_SIZE))  # texts per request
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 8000))  # whitespace tokens per request
+EMBEDDING_BATCH_WINDOW = 0.005  # seconds to gather concurrent query embeddings into one request
 EMBEDDING_MAX_RETRIES = 3
 EMBEDDING_TIMEOUT = 30
 
@@ -27,37 +32,96 @@ if MONGODB_USERNAME and MONGODB_PASSWORD and MONGODB_CLUSTER:
     MONGODB_URI = f"mongodb+srv://{MONGODB_USERNAME}:{MONGODB_PASSWORD}@{MONGODB_CLUSTER}/?retryWrites=true&w=majority&appName={MONGODB_APP_NAME}"
 
 MONGODB_DB_NAME = os.getenv("MONGODB_DB_NAME", "telegram_bot")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))  # connections per client
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 10))  # connections kept warm
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", 300000))  # idle connections closed after 5 minutes
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 5000))  # fail fast on pool exhaustion
 MONGODB_COLLECTIONS = {
     "messages": "message_queue",
-    "documents": "documents"
+    "documents": "documents",
+    "chunks": "document_chunks"
 }
 
 # Vector Search Configuration
 VECTOR_DIMENSIONS = 1024  # intfloat/multilingual-e5-large dimensions
-VECTOR_SIMILARITY = "cosine"
+VECTOR_SIMILARITY = "dotProduct"  # embeddings are stored and queried as unit vectors
 VECTOR_INDEX_NAME = "default"
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "scalar")  # Atlas index quantization: "none", "scalar" (int8), "binary"
+VECTOR_SEARCH_BACKEND = os.getenv("VECTOR_SEARCH_BACKEND", "atlas")  # Options: "atlas", "faiss" (in-process, needs faiss-cpu)
+FAISS_HNSW_M = 32  # graph neighbours per node
+FAISS_HNSW_EF_CONSTRUCTION = 200
+FAISS_HNSW_EF_SEARCH = 64
+FAISS_INDEX_CACHE_SIZE = 1000  # users whose local vector index is kept in memory
+FAISS_INDEX_CACHE_TTL = 3600  # seconds before an idle user's local vector index is evicted
 
 # Message Processing Configuration
 WAIT_TIME = 15  # seconds to wait for additional messages
 MAX_MESSAGES_PER_BATCH = 10  # maximum number of messages to process in one batch
+USER_CONTEXT_CACHE_SIZE = 100000  # maximum number of users whose reply context is kept
+USER_CONTEXT_TTL = 3600  # seconds before an idle user's reply context is evicted
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", 0))  # answered messages are pruned after this many days; 0 (default) keeps them forever
+LANGUAGE_DETECTION_MIN_CHARS = 20  # shorter messages reuse the user's last detected language
+STREAM_EDIT_INTERVAL = 1.0  # seconds between edits of a reply that is still being generated
 
 # Document Processing Configuration
-CHUNK_SIZE = 1000
+CHUNK_SIZE = 1000  # characters, used when the embedding tokenizer is unavailable
 CHUNK_OVERLAP = 200
+CHUNK_SIZE_TOKENS = 256  # embedding-model tokens per chunk (multilingual-e5-large reads at most 512)
+CHUNK_OVERLAP_TOKENS = 50
 DOCUMENT_UPLOAD_PATH = os.getenv("DOCUMENT_UPLOAD_PATH", "uploads")
+DOCUMENT_IN_MEMORY_MAX_BYTES = 8 * 1024 * 1024  # smaller uploads are processed without touching disk
+PDF_PARALLEL_MIN_PAGES = 16  # PDFs with at least this many pages are parsed by a process pool (needs pypdfium2)
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", os.cpu_count() or 1))
+FAILURE_RECORD_FLUSH_INTERVAL = 1.0  # seconds failed-upload records are gathered before one insert
+FAILURE_RECORD_BATCH_SIZE = 100  # failed-upload records written per insert
+USER_DOCS_CACHE_TTL = 60  # seconds to remember whether a user has any documents
+AVAILABLE_DOCS_CACHE_TTL = 30  # seconds to reuse a user's formatted document list
+DOCUMENT_ANSWER_CACHE_TTL = 300  # seconds a document answer can be reused for the same or a similar question
+DOCUMENT_ANSWER_SIMILARITY = 0.93  # cosine similarity above which two questions share an answer
+DOCUMENT_ANSWER_CACHE_PER_USER = 20  # recent question embeddings compared per user
+QUERY_EMBEDDING_CACHE_SIZE = 10000  # query variation texts whose embeddings are kept
+QUERY_EMBEDDING_CACHE_TTL = 3600  # seconds a query embedding is reused
+LLM_ANSWER_CACHE_SIZE = 10000  # answers kept per (question, retrieved chunks)
+LLM_ANSWER_CACHE_TTL = 3600  # seconds an answer over the same chunks is reused
+RESPONSE_CACHE_TTL = 3600  # seconds a full reply can be reused for the same or a similar message
+RESPONSE_CACHE_SIMILARITY = 0.97  # cosine similarity above which two messages share a reply
+RESPONSE_CACHE_PER_USER = 20  # recent message embeddings compared per user
+RESPONSE_CACHE_MIN_CHARS = 25  # shorter messages ("yes", "tell me more") depend on the conversation and are never cached
+RESPONSE_CACHE_FOLLOW_UP_PREFIXES = ("and ", "what about", "how about", "tell me more", "more ", "also ", "then ", "peki", "ya ")  # openings of follow-ups that are never cached
 
 # Language Model Configuration
 LLM_MODEL = "grok-3"  # xAI's Grok model
 LLM_TEMPERATURE = 0.7
+TOOL_TIMEOUT = 60  # seconds to wait for a single agent tool call
+LLM_MAX_KEEPALIVE_CONNECTIONS = 20  # pooled connections kept open to the xAI API
+LLM_BATCH_WINDOW = 0.05  # seconds ready user batches are gathered before dispatch
+LLM_BATCH_MAX_SIZE = 16  # user batches dispatched together
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", LLM_MAX_KEEPALIVE_CONNECTIONS))  # in-flight AI requests across users
+# Ready batches are binned by predicted response length so short chats never queue behind long answers
+BATCH_BIN_WAIT_TIMES = {"short": 5, "medium": 10, "long": WAIT_TIME}  # seconds to wait for additional messages
+BATCH_BIN_WINDOWS = {"short": 0.02, "medium": LLM_BATCH_WINDOW, "long": 0.1}  # scheduler gather window per bin
+SHORT_PROMPT_MAX_CHARS = 80  # shorter single questions are expected to get short answers
+LONG_PROMPT_MIN_CHARS = 400
+LONG_RESPONSE_KEYWORDS = ("summarize", "summarise", "summary", "explain", "compare", "list all", "ozetle", "özetle", "acikla", "açıkla")
 
-# Create necessary directories
-os.makedirs(DOCUMENT_UPLOAD_PATH, exist_ok=True)
+# Conversation Memory Configuration
+MEMORY_CACHE_SIZE = 10000  # maximum number of users kept in memory
+MEMORY_CACHE_TTL = 3600  # seconds before an idle user's memory is evicted
+MEMORY_MAX_TURNS = 10  # exchanges kept in a user's chat memory by the legacy message handler
+MEMORY_MAX_TOKEN_LIMIT = 1000  # older turns beyond this are rolled into a summary
+RECENT_HISTORY_SIZE = 6  # formatted history lines kept for prompt context (3 exchanges)
+HISTORY_TOOL_CACHE_TTL = 3  # seconds the history tool reuses its last lookup per user
 
 # Logging configuration
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s"
 LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-# Create logs directory
 LOGS_DIR = "logs"
-os.makedirs(LOGS_DIR, exist_ok=True)
+
+
+@lru_cache(maxsize=1)
+def ensure_dirs() -> None:
+    """Create the upload and logs directories (once per process)"""
+    os.makedirs(DOCUMENT_UPLOAD_PATH, exist_ok=True)
+    os.makedirs(LOGS_DIR, exist_ok=True)
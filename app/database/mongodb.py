@@ -1,21 +1,72 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Union
+import asyncio
 from datetime import datetime
 import logging
-from pymongo import MongoClient, ASCENDING
-from pymongo.operations import IndexModel
+import os
+import threading
+from bson import ObjectId
+from bson.binary import Binary, BinaryVectorDtype, VECTOR_SUBTYPE
+import numpy as np
+from pymongo import AsyncMongoClient, MongoClient, ASCENDING, ReadPreference
+from pymongo.errors import BulkWriteError, OperationFailure
+from pymongo.operations import IndexModel, SearchIndexModel, UpdateMany, UpdateOne
 
 from ..config import (
     MONGODB_URI, 
     MONGODB_DB_NAME, 
+    MONGODB_MAX_POOL_SIZE,
+    MONGODB_MIN_POOL_SIZE,
+    MONGODB_MAX_IDLE_TIME_MS,
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS,
     MONGODB_COLLECTIONS,
+    MESSAGE_RETENTION_DAYS,
     VECTOR_DIMENSIONS,
     VECTOR_SIMILARITY,
-    VECTOR_INDEX_NAME
+    VECTOR_QUANTIZATION,
+    VECTOR_INDEX_NAME,
+    VECTOR_SEARCH_BACKEND
 )
 
 from ..models.document import Document
 from ..models.message import MessageModel
 from ..utils.logging import db_logger, log_async_performance, log_performance
+from .vector_index import LocalVectorIndex, decode_vector
+
+# binData vector header: dtype byte followed by the padding byte (BinaryVectorDtype values are bytes)
+_FLOAT32_VECTOR_HEADER = BinaryVectorDtype.FLOAT32.value + b"\x00"
+
+
+def unit_vectors(embeddings: Any) -> np.ndarray:
+    """Scale each row to unit length so dotProduct scores equal cosine similarity"""
+    matrix = np.asarray(embeddings, dtype='<f4')
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def to_float32_vectors(embeddings: List[Any]) -> List[Binary]:
+    """
+    Pack embeddings as BSON float32 vectors (binData subtype 9): 4 bytes per
+    dimension instead of a tagged double per element, and still searchable by $vectorSearch.
+    All embeddings are normalized and converted in one numpy pass (same layout as Binary.from_vector).
+    """
+    matrix = unit_vectors(embeddings).astype('<f4', copy=False)
+    return [Binary(_FLOAT32_VECTOR_HEADER + row.tobytes(), VECTOR_SUBTYPE) for row in matrix]
+
+
+# Documents stored before chunks moved to their own collection still embed them;
+# listings and lookups never need the chunk text or embeddings
+_WITHOUT_CHUNKS = {"chunks": 0}
+
+# Partial index serving pending-message lookups (see _setup_indexes). Queries are not
+# hinted to it: a hint fails outright while the index is missing or still building
+_PENDING_MESSAGES_INDEX = "msg_user_processed_ts_idx"
+# TTL index that prunes answered messages when MESSAGE_RETENTION_DAYS is set
+_MESSAGE_TTL_INDEX = "message_processing_completed_ttl"
+
+# Server error codes: IndexOptionsConflict, IndexKeySpecsConflict, IndexAlreadyExists
+_INDEX_EXISTS_CODES = (85, 86, 68)
+_DUPLICATE_KEY_CODE = 11000
+
 
 class MongoDB:
     def __init__(self):
@@ -27,23 +78,41 @@ class MongoDB:
         db_logger.info(f"🗃️  Database: {MONGODB_DB_NAME}")
 
         # Enhanced connection settings for MongoDB Atlas
-        self.client = MongoClient(
-            MONGODB_URI,
+        client_options = dict(
             tls=True,
             tlsAllowInvalidCertificates=False,  # Use proper SSL verification for Atlas
             serverSelectionTimeoutMS=30000,    # 30 second timeout for Atlas
             connectTimeoutMS=30000,            # 30 second connection timeout
             socketTimeoutMS=30000,             # 30 second socket timeout
-            maxPoolSize=10,                    # Connection pool size
+            maxPoolSize=MONGODB_MAX_POOL_SIZE, # Connection pool size
+            minPoolSize=MONGODB_MIN_POOL_SIZE, # Warm connections kept for bursts
+            waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,  # Fail fast when the pool is exhausted
             retryWrites=True,                  # Enable retry writes
             retryReads=True,                   # Enable retry reads
-            maxIdleTimeMS=30000,               # Max idle time for connections
+            maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,  # Max idle time for connections
             heartbeatFrequencyMS=10000,        # Heartbeat frequency
             appName=MONGODB_COLLECTIONS.get("app_name", "DocExpertBot")  # Application name for monitoring
         )
+        self.client = MongoClient(MONGODB_URI, **client_options)
         self.db = self.client[MONGODB_DB_NAME]
         self.message_queue = self.db[MONGODB_COLLECTIONS["messages"]]
         self.documents = self.db[MONGODB_COLLECTIONS["documents"]]
+        self.chunks = self.db[MONGODB_COLLECTIONS["chunks"]]
+
+        # Native asyncio client for reads on the event loop (connects lazily)
+        self.async_client = AsyncMongoClient(MONGODB_URI, **client_options)
+        self.async_db = self.async_client[MONGODB_DB_NAME]
+        self.async_message_queue = self.async_db[MONGODB_COLLECTIONS["messages"]]
+        self.async_documents = self.async_db[MONGODB_COLLECTIONS["documents"]]
+        # Document listings tolerate replication lag, so they can be served by secondaries
+        self.async_documents_listing = self.async_documents.with_options(
+            read_preference=ReadPreference.SECONDARY_PREFERRED
+        )
+        self.async_chunks = self.async_db[MONGODB_COLLECTIONS["chunks"]]
+
+        # In-process FAISS fallback for deployments without Atlas Vector Search
+        self.local_vector_index = LocalVectorIndex(self.chunks) if LocalVectorIndex.available() else None
+        self._use_local_vector_index = VECTOR_SEARCH_BACKEND == "faiss" and self.local_vector_index is not None
 
         db_logger.info("✅ MongoDB client initialized")
         try:
@@ -53,8 +122,10 @@ class MongoDB:
             db_logger.warning(f"⚠️ Could not list collections: {e}")
 
         # Test connection
+        self._indexes_ready = False
         self._test_connection()
         self._setup_indexes()
+        self._migrate_embedded_chunks()
     
     def _test_connection(self):
         """Test MongoDB Atlas connection"""
@@ -71,72 +142,143 @@ class MongoDB:
             db_logger.info("   4. Verify credentials in .env file")
             # Don't raise exception, let app continue in offline mode
             db_logger.info("🔄 Continuing in offline mode...")
-        
-        self._setup_indexes()
     
     def _setup_indexes(self):
         """Setup database indexes for optimal query performance"""
+        if self._indexes_ready:
+            return
         db_logger.info("🔧 Setting up database indexes")
         
         try:
-            # Vector index for similarity search
-            try:
-                vector_index_result = self.documents.create_index([
-                    ("embedding", "2dsphere")
-                ], name="vector_index")
-                db_logger.debug(f"📊 Vector index: {vector_index_result}")
-            except Exception as e:
-                if "already exists" in str(e):
-                    db_logger.debug("📊 Vector index already exists, skipping")
-                else:
-                    raise
-            
-            # Text index for content search - check if it exists first
-            try:
-                # Check existing indexes to avoid conflicts
-                existing_indexes = list(self.documents.list_indexes())
-                text_index_exists = any("text" in idx.get("key", {}).values() for idx in existing_indexes)
-                
-                if not text_index_exists:
-                    text_index_result = self.documents.create_index([
-                        ("content", "text"),
-                        ("file_name", "text")
-                    ], name="content_text_index")
-                    db_logger.debug(f"🔍 Text index: {text_index_result}")
-                else:
-                    db_logger.debug("🔍 Text index already exists, skipping creation")
-            except Exception as e:
-                if "already exists" in str(e) or "IndexOptionsConflict" in str(e):
-                    db_logger.debug("🔍 Text index conflict detected, using existing index")
-                else:
-                    raise
-            
-            # Compound index for user-specific queries
-            try:
-                user_index_result = self.documents.create_index([
+            # Existing indexes are listed once per collection; everything below is gated on them
+            existing_indexes = list(self.documents.list_indexes())
+            document_index_names = {idx["name"] for idx in existing_indexes}
+            message_index_info = {idx["name"]: idx for idx in self.message_queue.list_indexes()}
+            message_index_names = set(message_index_info)
+            chunk_index_names = {idx["name"] for idx in self.chunks.list_indexes()}
+            
+            # Drop the legacy 2dsphere index on embedding; it never served similarity search
+            if "vector_index" in document_index_names:
+                self.documents.drop_index("vector_index")
+                db_logger.info("🗑️ Dropped legacy 2dsphere vector_index")
+            
+            # Text index for content search (only one text index is allowed per collection)
+            text_index_exists = any("text" in idx.get("key", {}).values() for idx in existing_indexes)
+            
+            document_indexes = [
+                # Compound index for user-specific queries
+                IndexModel([("user_id", 1), ("timestamp", -1)], name="user_timestamp_index")
+            ]
+            if not text_index_exists:
+                document_indexes.append(IndexModel([
+                    ("content", "text"),
+                    ("file_name", "text")
+                ], name="content_text_index"))
+            else:
+                db_logger.debug("🔍 Text index already exists, skipping creation")
+            self._create_indexes(self.documents, document_indexes, document_index_names)
+            
+            # File hash index for duplicate-upload lookups; failed-upload records carry no hash.
+            # Built on its own so existing duplicates cannot block the other indexes
+            if "file_hash_idx" not in document_index_names:
+                try:
+                    hash_index_result = self.documents.create_index(
+                        [("file_hash", 1)],
+                        name="file_hash_idx",
+                        unique=True,
+                        partialFilterExpression={"file_hash": {"$exists": True}}
+                    )
+                    db_logger.debug(f"#️⃣ File hash index: {hash_index_result}")
+                except OperationFailure as e:
+                    if e.code in _INDEX_EXISTS_CODES:
+                        db_logger.debug("#️⃣ File hash index already exists, skipping")
+                    elif e.code == _DUPLICATE_KEY_CODE:
+                        db_logger.warning("⚠️ Duplicate file hashes exist, file_hash index not created")
+                    else:
+                        raise
+            
+            # Every message_queue query also filters on is_processed, so the old
+            # (user_id, timestamp) index is superseded
+            if "message_user_timestamp_index" in message_index_names:
+                self.message_queue.drop_index("message_user_timestamp_index")
+                db_logger.info("🗑️ Dropped superseded message_user_timestamp_index")
+            
+            message_indexes = [
+                # Pending message index (Equality, Sort, Range): user_id and is_processed are
+                # matched exactly, then timestamp is walked in ascending order; only unprocessed
+                # messages are indexed, so its size tracks the live queue
+                IndexModel([
                     ("user_id", 1),
-                    ("timestamp", -1)
-                ], name="user_timestamp_index")
-                db_logger.debug(f"👤 User index: {user_index_result}")
-            except Exception as e:
-                if "already exists" in str(e):
-                    db_logger.debug("👤 User index already exists, skipping")
-                else:
-                    raise
-            
-            # Message queue index
-            try:
-                message_index_result = self.message_queue.create_index([
+                    ("is_processed", 1),
+                    ("timestamp", 1)
+                ], name=_PENDING_MESSAGES_INDEX, partialFilterExpression={"is_processed": False}),
+                # Message history index (user's processed messages, newest first)
+                IndexModel([
                     ("user_id", 1),
+                    ("is_processed", 1),
                     ("timestamp", -1)
-                ], name="message_user_timestamp_index")
-                db_logger.debug(f"💬 Message index: {message_index_result}")
-            except Exception as e:
-                if "already exists" in str(e):
-                    db_logger.debug("💬 Message index already exists, skipping")
+                ], name="message_user_processed_timestamp_index")
+            ]
+            # Answered messages expire (opt-in) so the queue does not grow with lifetime traffic;
+            # pending messages have no processing_completed and are never pruned
+            retention_seconds = MESSAGE_RETENTION_DAYS * 86400
+            ttl_index = message_index_info.get(_MESSAGE_TTL_INDEX)
+            if retention_seconds <= 0:
+                if ttl_index is not None:
+                    self.message_queue.drop_index(_MESSAGE_TTL_INDEX)
+                    db_logger.info(f"🗑️ Message retention disabled, dropped {_MESSAGE_TTL_INDEX}")
+            elif ttl_index is None:
+                message_indexes.append(IndexModel(
+                    [("processing_completed", 1)],
+                    name=_MESSAGE_TTL_INDEX,
+                    expireAfterSeconds=retention_seconds
+                ))
+            elif ttl_index.get("expireAfterSeconds") != retention_seconds:
+                # createIndexes cannot change an existing TTL; collMod updates it in place
+                self.db.command(
+                    "collMod",
+                    self.message_queue.name,
+                    index={"name": _MESSAGE_TTL_INDEX, "expireAfterSeconds": retention_seconds}
+                )
+                db_logger.info(f"⏳ Message retention changed to {MESSAGE_RETENTION_DAYS} days")
+            self._create_indexes(self.message_queue, message_indexes, message_index_names)
+            
+            self._create_indexes(self.chunks, [
+                # Lets uploads reuse the embedding of chunk text that was embedded before
+                IndexModel([("content_hash", 1)], name="chunk_content_hash_idx"),
+                # Per-user chunk counts and scans for the local vector index
+                IndexModel([("user_id", 1)], name="chunk_user_idx")
+            ], chunk_index_names)
+            
+            # Atlas Vector Search (HNSW) index over chunk embeddings, filterable by user
+            try:
+                existing_search_indexes = {idx["name"] for idx in self.chunks.list_search_indexes()}
+                if VECTOR_INDEX_NAME not in existing_search_indexes:
+                    self.chunks.create_search_index(SearchIndexModel(
+                        definition={
+                            "fields": [
+                                {
+                                    "type": "vector",
+                                    "path": "embedding",
+                                    "numDimensions": VECTOR_DIMENSIONS,
+                                    "similarity": VECTOR_SIMILARITY,
+                                    # The index keeps int8 copies of the stored float32 vectors
+                                    "quantization": VECTOR_QUANTIZATION
+                                },
+                                {"type": "filter", "path": "user_id"}
+                            ]
+                        },
+                        name=VECTOR_INDEX_NAME,
+                        type="vectorSearch"
+                    ))
+                    db_logger.debug(f"🧭 Vector search index requested: {VECTOR_INDEX_NAME}")
                 else:
-                    raise
+                    db_logger.debug("🧭 Vector search index already exists, skipping")
+            except Exception as e:
+                # Search indexes are an Atlas feature; plain deployments cannot serve $vectorSearch
+                db_logger.warning(f"⚠️ Could not set up vector search index: {str(e)}")
             
+            self._indexes_ready = True
             db_logger.info("✅ All database indexes created successfully")
             
         except Exception as e:
@@ -144,6 +286,22 @@ class MongoDB:
             # Don't raise the exception - let the app continue even if indexes fail
             db_logger.info("🔄 Continuing without index creation, app should still work")
     
+    @staticmethod
+    def _create_indexes(collection, indexes: List[IndexModel], existing_names: set) -> None:
+        """Create a collection's missing indexes in a single createIndexes round trip"""
+        indexes = [index for index in indexes if index.document["name"] not in existing_names]
+        if not indexes:
+            db_logger.debug(f"📇 {collection.name} indexes already exist, skipping")
+            return
+        try:
+            created = collection.create_indexes(indexes)
+            db_logger.debug(f"📇 {collection.name} indexes: {created}")
+        except OperationFailure as e:
+            if e.code in _INDEX_EXISTS_CODES:
+                db_logger.debug(f"📇 {collection.name} indexes already exist: {e}")
+            else:
+                raise
+    
     @log_async_performance("database")
     async def insert_message(self, message: MessageModel) -> str:
         """Insert a message into the database"""
@@ -151,7 +309,8 @@ class MongoDB:
         
         # Handle both custom Message class and potential other message types
         message_text = getattr(message, 'message', '') or getattr(message, 'text', '') or getattr(message, 'content', '')
-        db_logger.debug(f"📝 Message preview: {message_text[:100]}...")
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"📝 Message preview: {message_text[:100]}...")
         
         try:
             # Use to_dict() method if available, otherwise try model_dump()
@@ -171,35 +330,38 @@ class MongoDB:
             
             message_dict['timestamp'] = datetime.utcnow()
             
-            result = self.message_queue.insert_one(message_dict)
+            result = await self.async_message_queue.insert_one(message_dict)
             message_id = str(result.inserted_id)
             
             db_logger.info(f"✅ Message inserted successfully: {message_id}")
-            db_logger.debug(f"📊 Document ID: {message_id}")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"📊 Document ID: {message_id}")
             
             return message_id
             
         except Exception as e:
             db_logger.error(f"❌ Failed to insert message: {str(e)}")
             # Safe debug logging that won't fail
-            try:
-                if hasattr(message, 'to_dict'):
-                    debug_data = message.to_dict()
-                elif hasattr(message, 'model_dump'):
-                    debug_data = message.model_dump()
-                else:
-                    debug_data = f"Message type: {type(message)}, user_id: {getattr(message, 'user_id', 'unknown')}"
-                db_logger.debug(f"🔍 Message data: {debug_data}")
-            except:
-                db_logger.debug(f"🔍 Could not serialize message data for debugging")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                try:
+                    if hasattr(message, 'to_dict'):
+                        debug_data = message.to_dict()
+                    elif hasattr(message, 'model_dump'):
+                        debug_data = message.model_dump()
+                    else:
+                        debug_data = f"Message type: {type(message)}, user_id: {getattr(message, 'user_id', 'unknown')}"
+                    db_logger.debug(f"🔍 Message data: {debug_data}")
+                except:
+                    db_logger.debug(f"🔍 Could not serialize message data for debugging")
             raise
     
     @log_performance("database")
     def get_pending_messages(self, user_id: str, cutoff_time: datetime, limit: int) -> List[Dict[str, Any]]:
         """Get pending messages for processing"""
         db_logger.info(f"🔍 Getting pending messages for user {user_id}")
-        db_logger.debug(f"⏰ Cutoff time: {cutoff_time}")
-        db_logger.debug(f"📊 Limit: {limit}")
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"⏰ Cutoff time: {cutoff_time}")
+            db_logger.debug(f"📊 Limit: {limit}")
         
         try:
             messages = list(self.message_queue.find({
@@ -209,7 +371,8 @@ class MongoDB:
             }).sort("timestamp", ASCENDING).limit(limit))
             
             db_logger.info(f"✅ Found {len(messages)} pending messages")
-            db_logger.debug(f"📝 Message IDs: {[str(msg['_id']) for msg in messages]}")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"📝 Message IDs: {[str(msg['_id']) for msg in messages]}")
             
             return messages
             
@@ -217,16 +380,93 @@ class MongoDB:
             db_logger.error(f"❌ Failed to get pending messages: {str(e)}")
             raise
     
+    @log_async_performance("database")
+    async def aget_pending_messages(self, user_id: str, cutoff_time: datetime, limit: int) -> List[Dict[str, Any]]:
+        """Get pending messages for processing without blocking the event loop"""
+        db_logger.info(f"🔍 Getting pending messages for user {user_id}")
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"⏰ Cutoff time: {cutoff_time}")
+            db_logger.debug(f"📊 Limit: {limit}")
+        
+        try:
+            messages = await self.async_message_queue.find({
+                "user_id": user_id,
+                "is_processed": False,
+                "timestamp": {"$gte": cutoff_time}
+            }).sort("timestamp", ASCENDING).limit(limit).to_list(limit)
+            
+            db_logger.info(f"✅ Found {len(messages)} pending messages")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"📝 Message IDs: {[str(msg['_id']) for msg in messages]}")
+            
+            return messages
+            
+        except Exception as e:
+            db_logger.error(f"❌ Failed to get pending messages: {str(e)}")
+            raise
+    
+    @log_async_performance("database")
+    async def aclaim_pending_messages(self, user_id: str, cutoff_time: datetime, limit: int, batch_id: str) -> List[Dict[str, Any]]:
+        """
+        Fetch pending messages and atomically mark them as processed under batch_id.
+        Only messages this call flipped are returned, so concurrent workers never share one.
+        """
+        db_logger.info(f"🔍 Claiming pending messages for user {user_id}")
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"⏰ Cutoff time: {cutoff_time}")
+            db_logger.debug(f"🏷️  Batch ID: {batch_id}")
+        
+        try:
+            messages = await self.async_message_queue.find({
+                "user_id": user_id,
+                "is_processed": False,
+                "timestamp": {"$gte": cutoff_time}
+            }).sort("timestamp", ASCENDING).limit(limit).to_list(limit)
+            if not messages:
+                return []
+            
+            processing_started = datetime.utcnow()
+            result = await self.async_message_queue.update_many(
+                {"_id": {"$in": [msg["_id"] for msg in messages]}, "is_processed": False},
+                {
+                    "$set": {
+                        "is_processed": True,
+                        "batch_id": batch_id,
+                        "processing_started": processing_started
+                    }
+                }
+            )
+            
+            if result.modified_count != len(messages):
+                # Another worker claimed some of them first; keep only ours (the user's
+                # processed-messages index serves this instead of a collection scan)
+                messages = await self.async_message_queue.find(
+                    {"user_id": user_id, "is_processed": True, "batch_id": batch_id}
+                ).sort("timestamp", ASCENDING).to_list(limit)
+            else:
+                for msg in messages:
+                    msg.update(is_processed=True, batch_id=batch_id, processing_started=processing_started)
+            
+            db_logger.info(f"✅ Claimed {len(messages)} pending messages")
+            return messages
+            
+        except Exception as e:
+            db_logger.error(f"❌ Failed to claim pending messages: {str(e)}")
+            raise
+    
     @log_performance("database")
-    def mark_messages_as_processed(self, message_ids: List[str], batch_id: str):
-        """Mark messages as processed"""
+    def mark_messages_as_processed(self, message_ids: List[Union[str, ObjectId]], batch_id: str):
+        """Mark messages as processed (accepts ObjectIds or their string form)"""
         db_logger.info(f"✅ Marking {len(message_ids)} messages as processed")
-        db_logger.debug(f"🏷️  Batch ID: {batch_id}")
-        db_logger.debug(f"📝 Message IDs: {message_ids}")
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"🏷️  Batch ID: {batch_id}")
+            db_logger.debug(f"📝 Message IDs: {message_ids}")
         
         try:
+            # _id is stored as ObjectId; string ids would never match
+            object_ids = [ObjectId(message_id) if isinstance(message_id, str) else message_id for message_id in message_ids]
             result = self.message_queue.update_many(
-                {"_id": {"$in": message_ids}},
+                {"_id": {"$in": object_ids}},
                 {
                     "$set": {
                         "is_processed": True,
@@ -237,7 +477,8 @@ class MongoDB:
             )
             
             db_logger.info(f"✅ Updated {result.modified_count} messages")
-            db_logger.debug(f"🔍 Matched: {result.matched_count}, Modified: {result.modified_count}")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"🔍 Matched: {result.matched_count}, Modified: {result.modified_count}")
             
         except Exception as e:
             db_logger.error(f"❌ Failed to mark messages as processed: {str(e)}")
@@ -247,7 +488,8 @@ class MongoDB:
     def update_message_response(self, batch_id: str, response: str):
         """Update messages with response"""
         db_logger.info(f"📝 Updating message response for batch {batch_id}")
-        db_logger.debug(f"💬 Response preview: {response[:100]}...")
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"💬 Response preview: {response[:100]}...")
         
         try:
             result = self.message_queue.update_many(
@@ -261,7 +503,41 @@ class MongoDB:
             )
             
             db_logger.info(f"✅ Updated {result.modified_count} messages with response")
-            db_logger.debug(f"🔍 Matched: {result.matched_count}, Modified: {result.modified_count}")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"🔍 Matched: {result.matched_count}, Modified: {result.modified_count}")
+            
+        except Exception as e:
+            db_logger.error(f"❌ Failed to update message response: {str(e)}")
+            raise
+    
+    @log_async_performance("database")
+    async def acomplete_message_batch(
+        self,
+        batch_id: str,
+        last_message_id: Any,
+        response: str,
+        conversation_history: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Store a batch's response (and the last message's conversation history) in one round trip"""
+        db_logger.info(f"📝 Updating message response for batch {batch_id}")
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"💬 Response preview: {response[:100]}...")
+        
+        operations = [
+            UpdateMany(
+                {"batch_id": batch_id},
+                {"$set": {"processing_completed": datetime.utcnow(), "response": response}}
+            )
+        ]
+        if conversation_history is not None:
+            operations.append(UpdateOne(
+                {"_id": last_message_id},
+                {"$set": {"conversation_history": conversation_history}}
+            ))
+        
+        try:
+            result = await self.async_message_queue.bulk_write(operations, ordered=False)
+            db_logger.info(f"✅ Updated {result.modified_count} messages with response")
             
         except Exception as e:
             db_logger.error(f"❌ Failed to update message response: {str(e)}")
@@ -269,44 +545,154 @@ class MongoDB:
     
     @log_performance("database")
     def add_document(self, doc_info: Dict[str, Any]) -> str:
-        """Add a document to the database"""
+        """Add a document to the database, storing its chunks in the chunks collection"""
         db_logger.info(f"💾 Adding document to database")
-        db_logger.debug(f"📋 Document keys: {list(doc_info.keys())}")
-        db_logger.debug(f"📊 Chunks count: {len(doc_info.get('chunks', []))}")
+        chunks = doc_info.get("chunks") or []
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"📋 Document keys: {list(doc_info.keys())}")
+            db_logger.debug(f"📊 Chunks count: {len(chunks)}")
         
         try:
-            # Convert numpy arrays to lists for MongoDB storage
-            if "chunks" in doc_info:
-                db_logger.debug(f"🔄 Converting embeddings for {len(doc_info['chunks'])} chunks")
-                for i, chunk in enumerate(doc_info["chunks"]):
-                    if "embedding" in chunk and hasattr(chunk["embedding"], 'tolist'):
-                        chunk["embedding"] = chunk["embedding"].tolist()
-                        db_logger.debug(f"✅ Converted embedding for chunk {i+1}")
-            
-            result = self.documents.insert_one(doc_info)
+            embedded_chunks = self._pack_embeddings(chunks)
+            
+            # The parent document holds metadata only; chunks are searched on their own
+            document = {key: value for key, value in doc_info.items() if key != "chunks"}
+            result = self.documents.insert_one(document)
             document_id = str(result.inserted_id)
             
+            if chunks:
+                user_id = doc_info.get("user_id")
+                try:
+                    # Chunks are built by the document pipeline, so validation adds nothing but server work
+                    chunk_docs = self._chunk_documents(chunks, result.inserted_id, user_id, doc_info.get("file_hash"))
+                    self.chunks.insert_many(chunk_docs, ordered=True, bypass_document_validation=True)
+                except Exception:
+                    # Don't leave a document that can never be searched, or stray chunks
+                    self.chunks.delete_many({"doc_id": result.inserted_id})
+                    self.documents.delete_one({"_id": result.inserted_id})
+                    raise
+                db_logger.debug("📦 Stored %d chunks", len(chunks))
+                
+                if self.local_vector_index is not None and embedded_chunks:
+                    indexed = [chunk for chunk in chunk_docs if "embedding" in chunk]
+                    self.local_vector_index.add(
+                        user_id,
+                        [chunk["_id"] for chunk in indexed],
+                        np.vstack([decode_vector(chunk["embedding"]) for chunk in indexed])
+                    )
+            
             db_logger.info(f"✅ Document added successfully: {document_id}")
-            db_logger.debug(f"📊 Final document size: {len(str(doc_info))} chars")
             
             return document_id
             
         except Exception as e:
             db_logger.error(f"❌ Failed to add document: {str(e)}")
-            db_logger.debug(f"🔍 Document info: {doc_info.keys()}")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"🔍 Document info: {doc_info.keys()}")
             raise
     
+    @staticmethod
+    def _pack_embeddings(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Pack chunk embeddings in place as float32 BSON vectors; returns the chunks that have one"""
+        embedded_chunks = [chunk for chunk in chunks if "embedding" in chunk]
+        if embedded_chunks:
+            vectors = to_float32_vectors([decode_vector(chunk["embedding"]) for chunk in embedded_chunks])
+            for chunk, vector in zip(embedded_chunks, vectors):
+                chunk["embedding"] = vector
+            db_logger.debug("🔄 Converted embeddings for %d chunks", len(embedded_chunks))
+        return embedded_chunks
+    
+    @staticmethod
+    def _chunk_documents(chunks: List[Dict[str, Any]], doc_id: Any, user_id: str, file_hash: str) -> List[Dict[str, Any]]:
+        """
+        Build document_chunks entries for a parent document
+        
+        _id is "<file_hash>_<chunk_index:06d>", returned in index order so each
+        document's chunks append to one region of the _id B-tree instead of scattering.
+        """
+        chunk_docs = [
+            {
+                "_id": f"{file_hash}_{chunk.get('metadata', {}).get('chunk_index', position):06d}",
+                **chunk,
+                "doc_id": doc_id,
+                "user_id": user_id
+            }
+            for position, chunk in enumerate(chunks)
+        ]
+        chunk_docs.sort(key=lambda chunk: chunk["_id"])
+        return chunk_docs
+    
+    def _migrate_embedded_chunks(self) -> None:
+        """
+        Move chunks still embedded in parent documents into document_chunks
+        
+        Documents stored before chunks had their own collection would otherwise never be
+        found by search, and re-uploading them is rejected as a duplicate. Each parent's
+        chunks are copied, then removed from the parent, so an interrupted run resumes.
+        """
+        try:
+            migrated = 0
+            for document in self.documents.find({"chunks.0": {"$exists": True}}):
+                chunks = document["chunks"]
+                self._pack_embeddings(chunks)
+                chunk_docs = self._chunk_documents(
+                    chunks, document["_id"], document.get("user_id"), document.get("file_hash") or str(document["_id"])
+                )
+                try:
+                    self.chunks.insert_many(chunk_docs, ordered=False)
+                except BulkWriteError as e:
+                    # Chunks copied by an earlier, interrupted run are already there
+                    if any(error.get("code") != _DUPLICATE_KEY_CODE for error in e.details.get("writeErrors", [])):
+                        raise
+                self.documents.update_one(
+                    {"_id": document["_id"]},
+                    {"$unset": {"chunks": ""}, "$set": {"chunk_count": len(chunks)}}
+                )
+                migrated += 1
+            
+            if migrated:
+                db_logger.info(f"📦 Moved embedded chunks of {migrated} documents to {self.chunks.name}")
+        
+        except Exception as e:
+            db_logger.error(f"❌ Failed to migrate embedded chunks: {str(e)}")
+    
+    @log_async_performance("database")
+    async def aget_embeddings_by_content_hash(self, content_hashes: List[str], embedding_model: str) -> Dict[str, Any]:
+        """Map chunk content hashes to embeddings already stored for the same model"""
+        if not content_hashes:
+            return {}
+        
+        cursor = self.async_chunks.find(
+            {"content_hash": {"$in": content_hashes}, "metadata.embedding_model": embedding_model},
+            {"content_hash": 1, "embedding": 1, "_id": 0}
+        )
+        embeddings = {}
+        async for chunk in cursor:
+            if "embedding" in chunk:
+                vector = decode_vector(chunk["embedding"])
+                if vector.any():  # zero vectors are failed embeddings; never reuse them
+                    embeddings[chunk["content_hash"]] = vector
+        
+        db_logger.info(f"♻️ Reusing {len(embeddings)}/{len(content_hashes)} stored chunk embeddings")
+        return embeddings
+    
+    @log_async_performance("database")
+    async def acount_user_documents(self, user_id: str) -> int:
+        """Count a user's successfully processed documents"""
+        return await self.async_documents.count_documents({"user_id": user_id, "status": "processed"})
+    
     @log_performance("database")
     def get_document_by_hash(self, file_hash: str) -> Dict[str, Any]:
         """Get document by file hash"""
         db_logger.info(f"🔍 Looking up document by hash: {file_hash[:16]}...")
         
         try:
-            document = self.documents.find_one({"file_hash": file_hash})
+            document = self.documents.find_one({"file_hash": file_hash}, _WITHOUT_CHUNKS)
             
             if document:
                 db_logger.info(f"✅ Document found: {document.get('file_name', 'Unknown')}")
-                db_logger.debug(f"📊 Document ID: {document['_id']}")
+                if db_logger.isEnabledFor(logging.DEBUG):
+                    db_logger.debug(f"📊 Document ID: {document['_id']}")
             else:
                 db_logger.info(f"❌ No document found with hash: {file_hash[:16]}...")
             
@@ -317,15 +703,34 @@ class MongoDB:
             raise
     
     @log_performance("database")
-    def get_user_documents(self, user_id: str) -> List[Dict[str, Any]]:
-        """Get all documents for a user"""
+    def get_user_documents(self, user_id: str, projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Get all documents for a user (without chunk data unless a projection asks for it)"""
+        db_logger.info(f"📚 Getting all documents for user {user_id}")
+        
+        try:
+            documents = list(self.documents.find({"user_id": user_id}, projection or _WITHOUT_CHUNKS))
+            
+            db_logger.info(f"✅ Found {len(documents)} documents for user")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"📋 Document names: {[doc.get('file_name', 'Unknown') for doc in documents]}")
+            
+            return documents
+            
+        except Exception as e:
+            db_logger.error(f"❌ Failed to get user documents: {str(e)}")
+            raise
+    
+    @log_async_performance("database")
+    async def aget_user_documents(self, user_id: str, projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Get all documents for a user without blocking the event loop"""
         db_logger.info(f"📚 Getting all documents for user {user_id}")
         
         try:
-            documents = list(self.documents.find({"user_id": user_id}))
+            documents = await self.async_documents_listing.find({"user_id": user_id}, projection or _WITHOUT_CHUNKS).to_list(None)
             
             db_logger.info(f"✅ Found {len(documents)} documents for user")
-            db_logger.debug(f"📋 Document names: {[doc.get('file_name', 'Unknown') for doc in documents]}")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"📋 Document names: {[doc.get('file_name', 'Unknown') for doc in documents]}")
             
             return documents
             
@@ -335,97 +740,153 @@ class MongoDB:
     
     @log_performance("database")
     def search_similar_chunks(self, query_vector: List[float], user_id: str, k: int = 3) -> List[Dict[str, Any]]:
-        """Search for similar chunks using vector similarity"""
+        """Search for similar chunks using Atlas Vector Search"""
         db_logger.info(f"🔍 Searching for similar chunks for user {user_id}")
-        db_logger.debug(f"🎯 Query vector dimensions: {len(query_vector)}")
-        db_logger.debug(f"📊 Requested results: {k}")
+        if db_logger.isEnabledFor(logging.DEBUG):
+            db_logger.debug(f"🎯 Query vector dimensions: {len(query_vector)}")
+            db_logger.debug(f"📊 Requested results: {k}")
         
         try:
-            # Handle numpy array conversion if needed
-            if hasattr(query_vector, 'tolist'):
-                query_vector = query_vector.tolist()
-                db_logger.debug("🔄 Converted numpy array to list")
+            # Stored chunks are unit vectors; normalize the query once so the index only takes dot products
+            query_vector = unit_vectors(query_vector)
             
-            # MongoDB aggregation pipeline for vector similarity search
-            pipeline = [
-                {
-                    "$match": {
-                        "user_id": user_id,
-                        "chunks.embedding": {"$exists": True}
-                    }
-                },
-                {"$unwind": "$chunks"},
-                {
-                    "$addFields": {
-                        "similarity": {
-                            "$divide": [
-                                {
-                                    "$reduce": {
-                                        "input": {"$range": [0, {"$size": "$chunks.embedding"}]},
-                                        "initialValue": 0,
-                                        "in": {
-                                            "$add": [
-                                                "$$value",
-                                                {
-                                                    "$multiply": [
-                                                        {"$arrayElemAt": ["$chunks.embedding", "$$this"]},
-                                                        {"$arrayElemAt": [query_vector, "$$this"]}
-                                                    ]
-                                                }
-                                            ]
-                                        }
-                                    }
-                                },
-                                {
-                                    "$multiply": [
-                                        {
-                                            "$sqrt": {
-                                                "$reduce": {
-                                                    "input": "$chunks.embedding",
-                                                    "initialValue": 0,
-                                                    "in": {"$add": ["$$value", {"$multiply": ["$$this", "$$this"]}]}
-                                                }
-                                            }
-                                        },
-                                        {
-                                            "$sqrt": {
-                                                "$reduce": {
-                                                    "input": query_vector,
-                                                    "initialValue": 0,
-                                                    "in": {"$add": ["$$value", {"$multiply": ["$$this", "$$this"]}]}
-                                                }
-                                            }
-                                        }
-                                    ]
-                                }
-                            ]
-                        }
-                    }
-                },
-                {"$sort": {"similarity": -1}},
-                {"$limit": k},
-                {
-                    "$project": {
-                        "file_name": 1,
-                        "chunk_text": "$chunks.text",
-                        "chunk_index": "$chunks.chunk_index",
-                        "similarity": 1,
-                        "_id": 0
-                    }
-                }
-            ]
+            if self._use_local_vector_index:
+                return self._search_local_chunks(query_vector, user_id, k)
             
-            results = list(self.documents.aggregate(pipeline))
+            try:
+                results = list(self.chunks.aggregate(self._vector_search_pipeline(query_vector, user_id, k)))
+            except OperationFailure as e:
+                if self.local_vector_index is None:
+                    raise
+                # No Atlas Search on this deployment; stay on the local index from now on
+                db_logger.warning(f"⚠️ $vectorSearch unavailable, using local FAISS index: {e}")
+                self._use_local_vector_index = True
+                return self._search_local_chunks(query_vector, user_id, k)
             
             db_logger.info(f"✅ Found {len(results)} similar chunks")
-            db_logger.debug(f"📊 Similarity scores: {[r.get('similarity', 0) for r in results]}")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"📊 Similarity scores: {[r.get('score', 0) for r in results]}")
             
             return results
             
         except Exception as e:
             db_logger.error(f"❌ Failed to search similar chunks: {str(e)}")
-            db_logger.debug(f"🔍 Query vector shape: {len(query_vector) if query_vector else 'None'}")
+            if db_logger.isEnabledFor(logging.DEBUG):
+                db_logger.debug(f"🔍 Query vector shape: {len(query_vector) if query_vector is not None else 'None'}")
             raise
+    
+    @log_async_performance("database")
+    async def asearch_similar_chunks(self, query_vector: List[float], user_id: str, k: int = 3) -> List[Dict[str, Any]]:
+        """Search for similar chunks using Atlas Vector Search without blocking the event loop"""
+        db_logger.info(f"🔍 Searching for similar chunks for user {user_id}")
+        
+        try:
+            query_vector = unit_vectors(query_vector)
+            
+            if self._use_local_vector_index:
+                return await asyncio.to_thread(self._search_local_chunks, query_vector, user_id, k)
+            
+            try:
+                cursor = await self.async_chunks.aggregate(self._vector_search_pipeline(query_vector, user_id, k))
+                results = await cursor.to_list(k)
+            except OperationFailure as e:
+                if self.local_vector_index is None:
+                    raise
+                db_logger.warning(f"⚠️ $vectorSearch unavailable, using local FAISS index: {e}")
+                self._use_local_vector_index = True
+                return await asyncio.to_thread(self._search_local_chunks, query_vector, user_id, k)
+            
+            db_logger.info(f"✅ Found {len(results)} similar chunks")
+            return results
+            
+        except Exception as e:
+            db_logger.error(f"❌ Failed to search similar chunks: {str(e)}")
+            raise
+    
+    @staticmethod
+    def _vector_search_pipeline(query_vector: np.ndarray, user_id: str, k: int) -> List[Dict[str, Any]]:
+        """Approximate nearest-neighbour search over the HNSW index, pre-filtered by user"""
+        # Sent as a packed float32 vector: 4 bytes per dimension instead of a BSON double each
+        query_vector = Binary(_FLOAT32_VECTOR_HEADER + query_vector.astype('<f4', copy=False).tobytes(), VECTOR_SUBTYPE)
+        return [
+            {
+                "$vectorSearch": {
+                    "index": VECTOR_INDEX_NAME,
+                    "path": "embedding",
+                    "queryVector": query_vector,
+                    "numCandidates": k * 20,
+                    "limit": k,
+                    "filter": {"user_id": user_id}
+                }
+            },
+            {
+                "$project": {
+                    "content": 1,
+                    "metadata": 1,
+                    "score": {"$meta": "vectorSearchScore"},
+                    "_id": 0
+                }
+            }
+        ]
+    
+    def _search_local_chunks(self, query_vector: np.ndarray, user_id: str, k: int) -> List[Dict[str, Any]]:
+        """Rank chunks with the local FAISS index, then fetch their text from MongoDB"""
+        hits = self.local_vector_index.search(query_vector, user_id, k)
+        if not hits:
+            return []
+        
+        chunks_by_id = {
+            chunk["_id"]: chunk
+            for chunk in self.chunks.find(
+                {"_id": {"$in": [chunk_id for chunk_id, _ in hits]}},
+                {"content": 1, "metadata": 1}
+            )
+        }
+        results = [
+            {"content": chunk["content"], "metadata": chunk.get("metadata", {}), "score": score}
+            for chunk_id, score in hits
+            if (chunk := chunks_by_id.get(chunk_id)) is not None
+        ]
+        
+        db_logger.info(f"✅ Found {len(results)} similar chunks (local index)")
+        return results
+
+# Per-process instance, created on first use rather than at import
+_db: Optional[MongoDB] = None
+# get_db is also called from worker threads; only one of them may build the client
+_db_lock = threading.Lock()
+
+
+def get_db() -> MongoDB:
+    """Return this process's MongoDB instance, connecting on the first call"""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = MongoDB()
+    return _db
+
+
+def _reset_db_after_fork() -> None:
+    # Sockets inherited from the parent are unusable; the child opens its own pool.
+    # The lock is replaced too, in case the fork happened while another thread held it
+    global _db, _db_lock
+    _db = None
+    _db_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_db_after_fork)
+
+
+class _LazyMongoDB:
+    """Module-level `db` handle that resolves get_db() on attribute access"""
+
+    __slots__ = ()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_db(), name)
+
 
-# Create a singleton instance
-db = MongoDB()
+# Shared handle; importing this module no longer opens a connection
+db = _LazyMongoDB()
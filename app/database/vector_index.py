@@ -0,0 +1,134 @@
+"""
+In-process FAISS HNSW index over chunk embeddings.
+
+Used by MongoDB.search_similar_chunks when Atlas Vector Search is not available
+(self-hosted MongoDB, or VECTOR_SEARCH_BACKEND=faiss). MongoDB stays the source of
+truth: each user's vectors are streamed from the chunks collection into a
+per-user HNSW graph on first search, and only chunk ids live in the index.
+Indexes of idle users are evicted and rebuilt when the user's chunk count changes.
+"""
+
+from typing import Any, List, Tuple
+import threading
+
+import numpy as np
+from cachetools import TTLCache
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+from ..config import (
+    VECTOR_DIMENSIONS,
+    FAISS_HNSW_M,
+    FAISS_HNSW_EF_CONSTRUCTION,
+    FAISS_HNSW_EF_SEARCH,
+    FAISS_INDEX_CACHE_SIZE,
+    FAISS_INDEX_CACHE_TTL
+)
+from ..utils.logging import db_logger
+
+
+def decode_vector(value: Any) -> np.ndarray:
+    """Read a stored embedding (float32 binData vector or legacy list of doubles)"""
+    if isinstance(value, (bytes, bytearray)):
+        # binData subtype 9: dtype and padding bytes, then little-endian float32
+        return np.frombuffer(value, dtype='<f4', offset=2)
+    return np.asarray(value, dtype='<f4')
+
+
+class _UserIndex:
+    """One user's HNSW graph and the chunk ids behind its positions"""
+
+    __slots__ = ("index", "chunk_ids", "chunk_count")
+
+    def __init__(self):
+        # Embeddings are unit vectors, so inner product ranks like cosine similarity
+        self.index = faiss.IndexHNSWFlat(VECTOR_DIMENSIONS, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+        self.index.hnsw.efSearch = FAISS_HNSW_EF_SEARCH
+        self.chunk_ids: List[Any] = []
+        self.chunk_count = 0  # stored chunks this index reflects; a different count means it is stale
+
+    def add(self, chunk_ids: List[Any], vectors: np.ndarray) -> None:
+        if len(chunk_ids):
+            self.index.add(np.ascontiguousarray(vectors, dtype='float32'))
+            self.chunk_ids.extend(chunk_ids)
+            self.chunk_count += len(chunk_ids)
+
+
+class LocalVectorIndex:
+    """Per-user FAISS indexes built lazily from the chunks collection; idle users' indexes are evicted"""
+
+    def __init__(self, chunks_collection):
+        self.chunks = chunks_collection
+        self._indexes: TTLCache = TTLCache(maxsize=FAISS_INDEX_CACHE_SIZE, ttl=FAISS_INDEX_CACHE_TTL)
+        # One lock per user, so one user's build or search never blocks another's
+        self._user_locks: TTLCache = TTLCache(maxsize=FAISS_INDEX_CACHE_SIZE, ttl=FAISS_INDEX_CACHE_TTL)
+        self._lock = threading.Lock()  # guards the two caches only
+
+    @staticmethod
+    def available() -> bool:
+        return faiss is not None
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    def _load(self, user_id: str) -> _UserIndex:
+        """
+        Return the user's index (caller holds the user's lock), streaming their
+        embeddings from MongoDB when it is not cached or the user's chunk count
+        changed since it was built (e.g. chunks written or deleted by another process)
+        """
+        stored = self.chunks.count_documents({"user_id": user_id})
+        with self._lock:
+            user_index = self._indexes.get(user_id)
+            if user_index is not None and user_index.chunk_count == stored:
+                self._indexes[user_id] = user_index  # re-insert to refresh the TTL
+                return user_index
+
+        chunk_ids, vectors = [], []
+        scanned = 0
+        for chunk in self.chunks.find({"user_id": user_id}, {"embedding": 1}):
+            scanned += 1
+            if "embedding" in chunk:
+                chunk_ids.append(chunk["_id"])
+                vectors.append(decode_vector(chunk["embedding"]))
+
+        user_index = _UserIndex()
+        if vectors:
+            user_index.add(chunk_ids, np.vstack(vectors))
+        user_index.chunk_count = scanned
+        with self._lock:
+            self._indexes[user_id] = user_index
+        db_logger.info(f"🧭 Built local vector index for user {user_id}: {len(chunk_ids)} chunks")
+        return user_index
+
+    def add(self, user_id: str, chunk_ids: List[Any], vectors: np.ndarray) -> None:
+        """Append new chunks to an index that is already loaded (others load them on first search)"""
+        with self._user_lock(user_id):
+            with self._lock:
+                user_index = self._indexes.get(user_id)
+            if user_index is not None:
+                user_index.add(chunk_ids, vectors)
+
+    def search(self, query_vector: np.ndarray, user_id: str, k: int) -> List[Tuple[Any, float]]:
+        """Return (chunk _id, score) pairs for the user's k nearest chunks, best first"""
+        query = np.ascontiguousarray(query_vector, dtype='float32').reshape(1, -1)
+        # HNSW graphs are not safe to search while chunks are being added
+        with self._user_lock(user_id):
+            user_index = self._load(user_id)
+            if not user_index.chunk_ids:
+                return []
+            scores, positions = user_index.index.search(query, min(k, len(user_index.chunk_ids)))
+            chunk_ids = user_index.chunk_ids
+        return [
+            (chunk_ids[position], float(score))
+            for score, position in zip(scores[0], positions[0])
+            if position >= 0
+        ]
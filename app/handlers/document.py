@@ -1,4 +1,4 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Deque
 from datetime import datetime
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredFileLoader
@@ -6,32 +6,157 @@ from langchain.chains import RetrievalQA
 from langchain_xai import ChatXAI
 from langchain.schema import Document as LangchainDocument
 import os
+import io
+from functools import lru_cache
+import asyncio
+import hashlib
+import heapq
+from collections import deque
 import mimetypes
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import logging
+from cachetools import TTLCache
+from pypdf import PdfReader
 from langchain.prompts import ChatPromptTemplate
 
-from ..config import CHUNK_SIZE, CHUNK_OVERLAP, VECTOR_INDEX_NAME, VECTOR_DIMENSIONS, LLM_MODEL, XAI_API_KEY
+try:
+    # PDFium (C++) extracts text several times faster than pure-Python pypdf
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+from ..config import (
+    CHUNK_SIZE,
+    CHUNK_OVERLAP,
+    CHUNK_SIZE_TOKENS,
+    CHUNK_OVERLAP_TOKENS,
+    PDF_PARALLEL_MIN_PAGES,
+    PDF_PARSE_WORKERS,
+    FAILURE_RECORD_FLUSH_INTERVAL,
+    FAILURE_RECORD_BATCH_SIZE,
+    EMBEDDING_MODEL,
+    VECTOR_INDEX_NAME,
+    VECTOR_DIMENSIONS,
+    LLM_MODEL,
+    XAI_API_KEY,
+    QUERY_EMBEDDING_CACHE_SIZE,
+    QUERY_EMBEDDING_CACHE_TTL,
+    LLM_ANSWER_CACHE_SIZE,
+    LLM_ANSWER_CACHE_TTL
+)
 from ..database.mongodb import db
 from ..models.document import Document
 from ..services.embedding import embedding_service
 from ..utils.logging import log_async_performance, get_logger, log_user_interaction
+from .pdf_pages import read_pdf_pages
 
 # Setup dedicated logger for document pipeline
 doc_logger = get_logger('document_pipeline')
 
-class DocumentHandler:
-    def __init__(self):
-        self.text_splitter = RecursiveCharacterTextSplitter(
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+# File types process_document_bytes can read without writing them to disk
+IN_MEMORY_MIME_TYPES = {'application/pdf', DOCX_MIME_TYPE, 'text/plain', 'text/markdown', 'text/csv'}
+
+TEXT_SEPARATORS = ["\n\n", "\n", ".", "!", "?", ";", ":", " ", ""]
+
+
+@lru_cache(maxsize=1)
+def get_text_splitter() -> RecursiveCharacterTextSplitter:
+    """
+    Build the chunk splitter once, measuring length in embedding-model tokens so
+    chunks never overflow the model's input. Falls back to character length if
+    the tokenizer cannot be loaded.
+    """
+    try:
+        from tokenizers import Tokenizer
+        tokenizer = Tokenizer.from_pretrained(EMBEDDING_MODEL)
+    except Exception as e:
+        doc_logger.warning(f"⚠️ Could not load tokenizer for {EMBEDDING_MODEL}, splitting by characters: {str(e)}")
+        return RecursiveCharacterTextSplitter(
             chunk_size=CHUNK_SIZE,
             chunk_overlap=CHUNK_OVERLAP,
             length_function=len,
-            separators=["\n\n", "\n", ".", "!", "?", ";", ":", " ", ""]
+            separators=TEXT_SEPARATORS
         )
+    
+    def token_length(text: str) -> int:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE_TOKENS,
+        chunk_overlap=CHUNK_OVERLAP_TOKENS,
+        length_function=token_length,
+        separators=TEXT_SEPARATORS
+    )
+
+
+# PDFium is not thread-safe; every call made in this process (uploads parse in
+# worker threads) holds this lock. Pool workers are separate processes and call
+# read_pdf_pages directly.
+_PDFIUM_LOCK = threading.Lock()
+
+
+def _extract_pdf_pages(source: Any, start: int = 0, end: Optional[int] = None) -> List[str]:
+    """Extract the text of pages [start, end) with PDFium, in this process"""
+    with _PDFIUM_LOCK:
+        return read_pdf_pages(source, start, end)
+
+
+@lru_cache(maxsize=1)
+def _pdf_process_pool() -> ProcessPoolExecutor:
+    """
+    Shared pool for parsing large PDFs; PDFium is not thread-safe, so pages go to processes.
+    Workers are not forked from this multi-threaded process: a fork could copy
+    _PDFIUM_LOCK (or any other lock) while another thread holds it.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=PDF_PARSE_WORKERS, mp_context=multiprocessing.get_context(method))
+
+
+class PdfiumLoader:
+    """PDF loader backed by PDFium, spreading large files' pages across processes"""
+    
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+    
+    def load(self) -> List[LangchainDocument]:
+        with _PDFIUM_LOCK:
+            pdf = pypdfium2.PdfDocument(self.file_path)
+            page_count = len(pdf)
+            pdf.close()
+        
+        if page_count < PDF_PARALLEL_MIN_PAGES or PDF_PARSE_WORKERS < 2:
+            texts = _extract_pdf_pages(self.file_path, 0, page_count)
+        else:
+            # Contiguous page ranges, one per worker; each worker opens the file itself
+            step = -(-page_count // PDF_PARSE_WORKERS)
+            ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+            pool = _pdf_process_pool()
+            futures = [pool.submit(read_pdf_pages, self.file_path, start, end) for start, end in ranges]
+            texts = [text for future in futures for text in future.result()]
+        
+        return [
+            LangchainDocument(page_content=text, metadata={"source": self.file_path, "page": number})
+            for number, text in enumerate(texts)
+        ]
+
+
+class DocumentHandler:
+    def __init__(self):
         self.db = db  # Initialize MongoDB connection
         
         # Use the HuggingFace embedding service
         self.embedding_service = embedding_service
         self.embedding_dim = self.embedding_service.dimensions
+        # Query variation text -> embedding; repeated questions skip the embedding service
+        self._query_embeddings: TTLCache = TTLCache(maxsize=QUERY_EMBEDDING_CACHE_SIZE, ttl=QUERY_EMBEDDING_CACHE_TTL)
+        # (query, retrieved chunk ids) -> LLM answer
+        self._llm_answers: TTLCache = TTLCache(maxsize=LLM_ANSWER_CACHE_SIZE, ttl=LLM_ANSWER_CACHE_TTL)
+        # Failed-upload records waiting for the background writer
+        self._failure_records: Deque[Dict[str, Any]] = deque()
+        self._failure_writer: Optional[asyncio.Task] = None
         
         # Initialize xAI Chat model
         self.llm = ChatXAI(
@@ -50,11 +175,58 @@ class DocumentHandler:
         """Generate embedding for query using the HuggingFace service"""
         return await self.embedding_service.embed_query(query)
     
+    async def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Generate embeddings for several queries in one service call (cached queries are not sent)"""
+        embeddings = {}
+        for query in dict.fromkeys(queries):
+            cached = self._query_embeddings.get(query)
+            if cached is not None:
+                embeddings[query] = cached
+        
+        missing = [query for query in dict.fromkeys(queries) if query not in embeddings]
+        if missing:
+            for query, embedding in zip(missing, await self.embedding_service.embed_queries(missing)):
+                embeddings[query] = embedding
+                if any(embedding):  # zero vectors mean the request failed; don't keep them
+                    self._query_embeddings[query] = embedding
+        
+        return [embeddings[query] for query in queries]
+    
+    @staticmethod
+    def _content_hash(text: str) -> str:
+        """Fingerprint of a chunk's text, used to find an existing embedding for it"""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+    
+    async def _embed_chunks(self, chunk_texts: List[str], content_hashes: List[str]) -> List[Any]:
+        """Embed chunk texts, reusing stored embeddings for text that was embedded before"""
+        model_name = getattr(self.embedding_service, 'model', 'unknown')
+        try:
+            stored = await self.db.aget_embeddings_by_content_hash(list(set(content_hashes)), model_name)
+        except Exception as e:
+            doc_logger.warning(f"⚠️ Could not look up stored embeddings: {str(e)}")
+            stored = {}
+        # Zero vectors mean an earlier request failed; embed that text again
+        existing = {content_hash: embedding for content_hash, embedding in stored.items() if any(embedding)}
+        
+        missing = {}  # content hash -> text, one embedding per distinct text
+        for content_hash, text in zip(content_hashes, chunk_texts):
+            if content_hash not in existing:
+                missing.setdefault(content_hash, text)
+        
+        if missing:
+            new_embeddings = await self._embed_documents(list(missing.values()))
+            existing.update(zip(missing.keys(), new_embeddings))
+        doc_logger.info(f"🧠 Embedded {len(missing)} new texts, reused {len(chunk_texts) - len(missing)}")
+        
+        return [existing[content_hash] for content_hash in content_hashes]
+    
     def _get_loader(self, file_path: str):
         """Get appropriate loader based on file type"""
         mime_type, _ = mimetypes.guess_type(file_path)
         
         if mime_type == 'application/pdf':
+            if pypdfium2 is not None:
+                return PdfiumLoader(file_path)
             return PyPDFLoader(file_path)
         elif mime_type in ['application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document']:
             return Docx2txtLoader(file_path)
@@ -77,7 +249,7 @@ class DocumentHandler:
         try:
             # Create document instance
             doc_logger.debug("🔨 Creating document instance")
-            document = Document.create(user_id, file_path)
+            document = await asyncio.to_thread(Document.create, user_id, file_path)
             doc_logger.info(f"🔍 Document hash: {document.file_hash}")
             doc_logger.info(f"📝 Document metadata: {document.metadata}")
             
@@ -93,151 +265,254 @@ class DocumentHandler:
             loader = self._get_loader(file_path)
             doc_logger.debug(f"🔧 Using loader: {type(loader).__name__}")
             
-            raw_documents = loader.load()
+            # Parsing is blocking and CPU-bound; keep it off the event loop
+            raw_documents = await asyncio.to_thread(loader.load)
             doc_logger.info(f"📚 Loaded {len(raw_documents)} raw document(s)")
             
-            # Combine all text from the document
-            full_text = "\n\n".join([doc.page_content for doc in raw_documents])
-            doc_logger.info(f"📝 Full text length: {len(full_text)} characters")
-            doc_logger.debug(f"📄 Text preview: {full_text[:200]}...")
-            
-            # Split into chunks with better context preservation
-            doc_logger.info("✂️  Splitting document into chunks")
-            chunks = self.text_splitter.create_documents(
-                texts=[full_text],
-                metadatas=[{
-                    "user_id": user_id,
-                    "file_hash": document.file_hash,
-                    "file_name": os.path.basename(file_path),
-                    "source": file_path
-                }]
-            )
-            doc_logger.info(f"📊 Created {len(chunks)} chunks")
-            doc_logger.debug(f"📏 Average chunk size: {sum(len(chunk.page_content) for chunk in chunks) / len(chunks):.0f} chars")
-            
-            # Update document with chunk information
-            document.chunk_count = len(chunks)
-            doc_logger.info(f"📋 Updated document with {document.chunk_count} chunks")
+            return await self._index_document(document, raw_documents, user_id, file_path)
             
-            # Get embeddings for all chunks using the service
-            chunk_texts = [chunk.page_content for chunk in chunks]
-            doc_logger.info(f"🧠 Generating embeddings for {len(chunk_texts)} chunks")
-            doc_logger.debug(f"🔧 Using embedding service: {type(self.embedding_service).__name__}")
-            
-            embedding_start_time = datetime.now()
-            all_embeddings = await self._embed_documents(chunk_texts)
-            embedding_duration = (datetime.now() - embedding_start_time).total_seconds()
-            
-            doc_logger.info(f"✅ Generated {len(all_embeddings)} embeddings in {embedding_duration:.2f}s")
-            doc_logger.debug(f"📊 Embedding dimensions: {len(all_embeddings[0])} per chunk")
-            doc_logger.debug(f"⚡ Average embedding time: {embedding_duration / len(chunk_texts):.3f}s per chunk")
-            
-            # Create chunks with embeddings and better metadata
-            chunks_data = []
-            doc_logger.info("📦 Processing chunks for storage")
-            
-            for i, (chunk, embedding) in enumerate(zip(chunks, all_embeddings)):
-                chunk_id = f"{document.file_hash}_{i}"
-                chunk_text = chunk.page_content.strip()
-                
-                # Skip empty chunks
-                if not chunk_text:
-                    doc_logger.debug(f"⏭️  Skipping empty chunk {i}")
-                    continue
-                
-                doc_logger.debug(f"📝 Processing chunk {i+1}/{len(chunks)}: {len(chunk_text)} chars")
-                
-                # Create chunk metadata
-                chunk_metadata = {
-                    "user_id": user_id,
-                    "file_hash": document.file_hash,
-                    "chunk_id": chunk_id,
-                    "chunk_index": i,
-                    "source": file_path,
-                    "file_name": os.path.basename(file_path),
-                    "total_chunks": len(chunks),
-                    "char_length": len(chunk_text),
-                    "word_count": len(chunk_text.split()),
-                    "created_at": datetime.utcnow(),
-                    "embedding_service": type(self.embedding_service).__name__,
-                    "embedding_model": getattr(self.embedding_service, 'model', 'unknown')
-                }
-                
-                chunks_data.append({
-                    "chunk_id": chunk_id,
-                    "content": chunk_text,
-                    "embedding": embedding,
-                    "metadata": chunk_metadata
-                })
-            
-            doc_logger.info(f"📦 Prepared {len(chunks_data)} chunks for storage")
-            doc_logger.debug(f"📊 Total characters processed: {sum(len(chunk['content']) for chunk in chunks_data)}")
-            doc_logger.debug(f"📈 Average words per chunk: {sum(chunk['metadata']['word_count'] for chunk in chunks_data) / len(chunks_data):.1f}")
-            
-            # Update document with chunks data
-            document.chunks = chunks_data
-            document.status = "processed"
-            doc_logger.info(f"✅ Document status updated to: {document.status}")
+        except Exception as e:
+            self._record_failure(user_id, file_path, e)
+            raise
+    
+    def supports_in_memory(self, file_name: str) -> bool:
+        """Whether process_document_bytes can read this file type without a file on disk"""
+        mime_type, _ = mimetypes.guess_type(file_name)
+        return mime_type in IN_MEMORY_MIME_TYPES
+    
+    def _extract_text(self, data: bytes, file_name: str) -> List[LangchainDocument]:
+        """Extract the text of an in-memory document (one Document per PDF page)"""
+        mime_type, _ = mimetypes.guess_type(file_name)
+        
+        if mime_type == 'application/pdf' and pypdfium2 is not None:
+            return [
+                LangchainDocument(page_content=text, metadata={"page": number})
+                for number, text in enumerate(_extract_pdf_pages(data))
+            ]
+        elif mime_type == 'application/pdf':
+            reader = PdfReader(io.BytesIO(data))
+            return [
+                LangchainDocument(page_content=page.extract_text() or "", metadata={"page": number})
+                for number, page in enumerate(reader.pages)
+            ]
+        elif mime_type == DOCX_MIME_TYPE:
+            import docx2txt
+            return [LangchainDocument(page_content=docx2txt.process(io.BytesIO(data)))]
+        else:
+            return [LangchainDocument(page_content=data.decode("utf-8", errors="replace"))]
+    
+    async def process_document_bytes(self, data: bytes, file_name: str, user_id: str) -> Dict[str, Any]:
+        """Process a document held in memory and store it with embeddings in MongoDB"""
+        doc_logger.info(f"📄 Starting in-memory document processing for user {user_id}")
+        doc_logger.info(f"📁 File name: {file_name}")
+        doc_logger.info(f"📊 File size: {len(data) / 1024:.2f} KB")
+        
+        try:
+            # Create document instance
+            doc_logger.debug("🔨 Creating document instance")
+            document = Document.create_from_bytes(user_id, data, file_name)
+            doc_logger.info(f"🔍 Document hash: {document.file_hash}")
+            doc_logger.info(f"📝 Document metadata: {document.metadata}")
             
-            # Store document in MongoDB
-            doc_logger.info("💾 Storing document in MongoDB")
-            storage_start_time = datetime.now()
-            doc_id = self.db.add_document(document.to_dict())
-            storage_duration = (datetime.now() - storage_start_time).total_seconds()
+            # Check if document already exists
+            doc_logger.debug("🔍 Checking for existing document")
+            existing_doc = self.db.get_document_by_hash(document.file_hash)
+            if existing_doc:
+                doc_logger.info(f"♻️  Document already exists with ID: {existing_doc['_id']}")
+                return {"status": "exists", "doc_id": existing_doc["_id"]}
             
-            doc_logger.info(f"✅ Document stored successfully with ID: {doc_id}")
-            doc_logger.info(f"⏱️  Storage completed in {storage_duration:.3f}s")
+            # Extract text straight from the downloaded bytes
+            doc_logger.info("📖 Loading document content")
+            raw_documents = await asyncio.to_thread(self._extract_text, data, file_name)
+            doc_logger.info(f"📚 Loaded {len(raw_documents)} raw document(s)")
             
-            return {
-                "status": "success",
-                "doc_id": doc_id,
-                "file_hash": document.file_hash,
-                "chunk_count": len(chunks_data),
-                "metadata": document.metadata
-            }
+            return await self._index_document(document, raw_documents, user_id, file_name)
             
         except Exception as e:
-            doc_logger.error(f"❌ Document processing failed for user {user_id}")
-            doc_logger.error(f"📁 File: {file_path}")
-            doc_logger.error(f"💥 Error: {str(e)}", exc_info=True)
-            
-            error_info = {
-                "user_id": user_id,
-                "file_path": file_path,
-                "error": str(e),
-                "timestamp": datetime.utcnow(),
-                "status": "failed"
-            }
-            
-            try:
-                self.db.add_document(error_info)
-                doc_logger.info("📝 Error info stored in database")
-            except Exception as db_error:
-                doc_logger.error(f"💥 Failed to store error info: {str(db_error)}")
-            
+            self._record_failure(user_id, file_name, e)
             raise
     
+    async def _index_document(self, document: Document, raw_documents: List[LangchainDocument], user_id: str, file_path: str) -> Dict[str, Any]:
+        """Split, embed and store a loaded document"""
+        doc_logger.info(f"📝 Full text length: {sum(len(doc.page_content) for doc in raw_documents)} characters")
+        
+        # Split page by page; the pages are never joined into one string
+        doc_logger.info("✂️  Splitting document into chunks")
+        file_metadata = {
+            "user_id": user_id,
+            "file_hash": document.file_hash,
+            "file_name": os.path.basename(file_path),
+            "source": file_path
+        }
+        for raw_document in raw_documents:
+            raw_document.metadata.update(file_metadata)
+        chunks = await asyncio.to_thread(lambda: get_text_splitter().split_documents(raw_documents))
+        doc_logger.info(f"📊 Created {len(chunks)} chunks")
+        doc_logger.debug(f"📏 Average chunk size: {sum(len(chunk.page_content) for chunk in chunks) / len(chunks):.0f} chars")
+        
+        # Update document with chunk information
+        document.chunk_count = len(chunks)
+        doc_logger.info(f"📋 Updated document with {document.chunk_count} chunks")
+        
+        # Get embeddings for all chunks using the service
+        chunk_texts = [chunk.page_content for chunk in chunks]
+        content_hashes = [self._content_hash(text) for text in chunk_texts]
+        doc_logger.info(f"🧠 Generating embeddings for {len(chunk_texts)} chunks")
+        doc_logger.debug(f"🔧 Using embedding service: {type(self.embedding_service).__name__}")
+        
+        embedding_start_time = datetime.now()
+        all_embeddings = await self._embed_chunks(chunk_texts, content_hashes)
+        embedding_duration = (datetime.now() - embedding_start_time).total_seconds()
+        
+        doc_logger.info(f"✅ Generated {len(all_embeddings)} embeddings in {embedding_duration:.2f}s")
+        doc_logger.debug(f"📊 Embedding dimensions: {len(all_embeddings[0])} per chunk")
+        doc_logger.debug(f"⚡ Average embedding time: {embedding_duration / len(chunk_texts):.3f}s per chunk")
+        
+        # Create chunks with embeddings and better metadata
+        doc_logger.info("📦 Processing chunks for storage")
+        
+        # Values shared by every chunk of this document
+        shared_metadata = {
+            "user_id": user_id,
+            "file_hash": document.file_hash,
+            "source": file_path,
+            "file_name": os.path.basename(file_path),
+            "total_chunks": len(chunks),
+            "created_at": datetime.utcnow(),
+            "embedding_service": type(self.embedding_service).__name__,
+            "embedding_model": getattr(self.embedding_service, 'model', 'unknown')
+        }
+        
+        # Empty chunks are dropped in the same pass
+        chunks_data = [
+            self._make_chunk_doc(i, chunk_text, embedding, content_hashes[i], shared_metadata, chunk_metadata)
+            for i, (chunk_text, embedding, chunk_metadata) in enumerate(
+                (chunk.page_content.strip(), embedding, chunk.metadata)
+                for chunk, embedding in zip(chunks, all_embeddings)
+            )
+            if chunk_text
+        ]
+        
+        doc_logger.info(f"📦 Prepared {len(chunks_data)} chunks for storage")
+        if chunks_data and doc_logger.isEnabledFor(logging.DEBUG):
+            doc_logger.debug(f"⏭️  Skipped {len(chunks) - len(chunks_data)} empty chunks")
+            doc_logger.debug(f"📊 Total characters processed: {sum(chunk['metadata']['char_length'] for chunk in chunks_data)}")
+            doc_logger.debug(f"📈 Average words per chunk: {sum(chunk['metadata']['word_count'] for chunk in chunks_data) / len(chunks_data):.1f}")
+        
+        # Update document with chunks data
+        document.chunks = chunks_data
+        document.status = "processed"
+        doc_logger.info(f"✅ Document status updated to: {document.status}")
+        
+        # Store document in MongoDB
+        doc_logger.info("💾 Storing document in MongoDB")
+        storage_start_time = datetime.now()
+        doc_id = self.db.add_document(document.to_dict())
+        storage_duration = (datetime.now() - storage_start_time).total_seconds()
+        
+        doc_logger.info(f"✅ Document stored successfully with ID: {doc_id}")
+        doc_logger.info(f"⏱️  Storage completed in {storage_duration:.3f}s")
+        
+        return {
+            "status": "success",
+            "doc_id": doc_id,
+            "file_hash": document.file_hash,
+            "chunk_count": len(chunks_data),
+            "metadata": document.metadata
+        }
+    
+    @staticmethod
+    def _make_chunk_doc(
+        index: int,
+        chunk_text: str,
+        embedding: Any,
+        content_hash: str,
+        shared_metadata: Dict[str, Any],
+        chunk_metadata: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Build the stored form of one chunk, keeping the loader's page number when it has one"""
+        chunk_id = f"{shared_metadata['file_hash']}_{index}"
+        chunk_doc = {
+            "chunk_id": chunk_id,
+            "content": chunk_text,
+            "embedding": embedding,
+            "metadata": {
+                **shared_metadata,
+                **{key: value for key, value in (chunk_metadata or {}).items() if key == "page"},
+                "chunk_id": chunk_id,
+                "chunk_index": index,
+                "char_length": len(chunk_text),
+                "word_count": len(chunk_text.split())
+            }
+        }
+        # Only real embeddings are findable by content hash for reuse
+        if any(embedding):
+            chunk_doc["content_hash"] = content_hash
+        return chunk_doc
+    
+    @staticmethod
+    def _section_label(metadata: Dict[str, Any]) -> str:
+        """Where a chunk came from, for the answer prompt (loaders number pages from 0)"""
+        section = f"Section {metadata.get('chunk_index', 0) + 1}"
+        if metadata.get("page") is not None:
+            return f"Page {metadata['page'] + 1}, {section}"
+        return section
+    
+    def _record_failure(self, user_id: str, file_path: str, error: Exception) -> None:
+        """Log a failed document and store the error info"""
+        doc_logger.error(f"❌ Document processing failed for user {user_id}")
+        doc_logger.error(f"📁 File: {file_path}")
+        doc_logger.error(f"💥 Error: {str(error)}", exc_info=True)
+        
+        error_info = {
+            "user_id": user_id,
+            "file_path": file_path,
+            "error": str(error),
+            "timestamp": datetime.utcnow(),
+            "status": "failed"
+        }
+        
+        # Stored in the background so the failing upload isn't held up (or masked) by the write
+        self._failure_records.append(error_info)
+        if self._failure_writer is None or self._failure_writer.done():
+            self._failure_writer = asyncio.create_task(self._write_failure_records())
+    
+    async def _write_failure_records(self) -> None:
+        """Store queued failure records in batches"""
+        while self._failure_records:
+            await asyncio.sleep(FAILURE_RECORD_FLUSH_INTERVAL)
+            while self._failure_records:
+                batch = [
+                    self._failure_records.popleft()
+                    for _ in range(min(FAILURE_RECORD_BATCH_SIZE, len(self._failure_records)))
+                ]
+                try:
+                    await self.db.async_documents.insert_many(batch, ordered=False)
+                    doc_logger.info(f"📝 Stored {len(batch)} error info record(s) in database")
+                except Exception as db_error:
+                    doc_logger.error(f"💥 Failed to store error info: {str(db_error)}")
+    
     async def query_documents(self, query: str, user_id: str, k: int = 20) -> Dict[str, Any]:
         """Query documents using MongoDB vector search"""
         doc_logger.info(f"🔍 Starting document query for user {user_id}")
         doc_logger.info(f"❓ Query: '{query}'")
         doc_logger.debug(f"📊 Requested results: {k}")
         
+        total_docs = 0
+        all_chunks = []
         try:
-            # Get user's documents from MongoDB
-            doc_logger.debug("📚 Fetching user documents from database")
-            user_docs = self.db.get_user_documents(user_id)
+            # Count the user's processed documents; no document bodies are read
+            doc_logger.debug("📚 Counting user documents in database")
+            total_docs = await self.db.acount_user_documents(user_id)
             
-            if not user_docs:
+            if not total_docs:
                 doc_logger.info(f"📭 No documents found for user {user_id}")
                 return {
                     "answer": "No documents found in your collection.",
                     "sources": []
                 }
             
-            doc_logger.info(f"📚 Found {len(user_docs)} documents for user")
-            total_chunks = sum(len(doc.get('chunks', [])) for doc in user_docs)
-            doc_logger.debug(f"📦 Total searchable chunks: {total_chunks}")
+            doc_logger.info(f"📚 Found {total_docs} documents for user")
 
             # Generate semantic variations for better search coverage
             doc_logger.debug("🔄 Generating semantic query variations")
@@ -252,70 +527,58 @@ class DocumentHandler:
             doc_logger.debug(f"🔍 Created {len(semantic_variations)} query variations")
             
             all_chunks = []
-            seen_chunk_ids = set()
+            # Best-scoring hit per (file_hash, chunk_index) across all variations
+            best_chunks: Dict[tuple, Dict[str, Any]] = {}
             
-            # Search with each variation and collect results
-            for variation in semantic_variations:
-                # Get embedding for the variation using the service
-                query_embedding = await self._embed_query(variation)
-                
-                # Search similar chunks
-                chunks = self.db.search_similar_chunks(query_embedding, user_id, k=5)
+            # Embed all variations in one request
+            variation_embeddings = await self._embed_queries(semantic_variations)
+            
+            # Search with all variations concurrently and collect results
+            search_results = await asyncio.gather(*[
+                self.db.asearch_similar_chunks(query_embedding, user_id, k=5)
+                for query_embedding in variation_embeddings
+            ], return_exceptions=True)
+            
+            for chunks in search_results:
+                if isinstance(chunks, Exception):
+                    doc_logger.warning(f"⚠️ Variation search failed: {chunks}")
+                    continue
                 
-                # Add unique chunks to results
+                # Keep each chunk once, with its highest score
                 for chunk in chunks:
-                    chunk_id = f"{chunk['metadata'].get('file_hash', '')}_{chunk['metadata'].get('chunk_index', '')}"
-                    if chunk_id not in seen_chunk_ids:
-                        seen_chunk_ids.add(chunk_id)
-                        all_chunks.append(chunk)
+                    metadata = chunk['metadata']
+                    key = (metadata.get('file_hash'), metadata.get('chunk_index'))
+                    best = best_chunks.get(key)
+                    if best is None or chunk.get('score', 0) > best.get('score', 0):
+                        best_chunks[key] = chunk
             
+            all_chunks = list(best_chunks.values())
             if not all_chunks:
                 return {
                     "answer": "No relevant content found in your documents.",
                     "sources": []
                 }
             
-            # Sort chunks by similarity score
-            all_chunks.sort(key=lambda x: x.get("score", 0), reverse=True)
-            
-            # Take top k most relevant chunks
-            top_chunks = all_chunks[:k]
-            
-            # Create context with full content
-            contexts = []
-            sources = []
+            # Take top k most relevant chunks, best first (partial selection, no full sort)
+            top_chunks = heapq.nlargest(k, all_chunks, key=lambda x: x.get("score", 0))
             
-            for chunk in top_chunks:
-                metadata = chunk["metadata"]
-                score = chunk.get("score", 0)
-                
-                # Create Langchain Document objects
-                doc = LangchainDocument(
-                    page_content=chunk["content"],
-                    metadata={
-                        "source": metadata.get("file_name", "Unknown"),
-                        "section": metadata.get("chunk_index", 0) + 1,
-                        "score": score
-                    }
-                )
-                contexts.append(doc)
-                
-                # Add to sources with full content
-                sources.append({
+            # Sources and prompt context straight from the chunk dicts
+            sources = [
+                {
                     "content": chunk["content"],
-                    "metadata": metadata,
-                    "similarity_score": score
-                })
-            
-            # Create context string from documents
-            context_str = "\n\n".join([
-                f"From {doc.metadata['source']} (Section {doc.metadata['section']}):\n{doc.page_content}"
-                for doc in contexts
-            ])
+                    "metadata": chunk["metadata"],
+                    "similarity_score": chunk.get("score", 0)
+                }
+                for chunk in top_chunks
+            ]
+            context_str = "\n\n".join(
+                f"From {chunk['metadata'].get('file_name', 'Unknown')} "
+                f"({self._section_label(chunk['metadata'])}):\n{chunk['content']}"
+                for chunk in top_chunks
+            )
 
             # Create prompt template
             from langchain.prompts import PromptTemplate
-            from langchain_core.runnables import RunnablePassthrough
             
             prompt = PromptTemplate(
                 template="""You are a knowledgeable assistant providing clear and concise information.
@@ -349,29 +612,37 @@ class DocumentHandler:
                 | self.llm
             )
             
-            # Get response using the new invoke method
-            response = chain.invoke({"question": query})
-            answer = response.content if hasattr(response, 'content') else str(response)
+            # Same question over the same chunks gets the same answer; skip the LLM call
+            answer_key = (query, tuple(sorted(chunk['metadata'].get('chunk_id', '') for chunk in top_chunks)))
+            answer = self._llm_answers.get(answer_key)
+            if answer is None:
+                # Awaited so other users' requests keep running during the xAI round trip
+                response = await chain.ainvoke({"question": query})
+                answer = response.content if hasattr(response, 'content') else str(response)
+                self._llm_answers[answer_key] = answer
+            else:
+                doc_logger.info("♻️ Reusing cached answer for identical retrieval")
             
 
             return {
                 "answer": answer,
                 "sources": sources,
-                "total_docs": len(user_docs),
-                "docs_used": len(seen_chunk_ids)
+                "total_docs": total_docs,
+                "docs_used": len(best_chunks)
             }
 
         except Exception as e:
-            print(f"Error in query_documents: {str(e)}")
+            doc_logger.error(f"❌ Error in query_documents: {str(e)}")
             # Fallback to direct content return
             if all_chunks:
+                best = heapq.nlargest(3, all_chunks, key=lambda x: x.get("score", 0))
                 answer = "Here's what I found in the documents:\n\n"
-                for chunk in all_chunks[:3]:
+                for chunk in best:
                     answer += f"- {chunk['content']}\n\n"
                 return {
                     "answer": answer,
-                    "sources": all_chunks[:3],
-                    "total_docs": len(user_docs),
+                    "sources": best,
+                    "total_docs": total_docs,
                     "docs_used": len(all_chunks)
                 }
             return {
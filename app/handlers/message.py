@@ -1,42 +1,124 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Callable, Awaitable
 from datetime import datetime, timedelta
 import asyncio
+import uuid
+import json
+import re
+from itertools import islice
 import logging
-from langchain_xai import ChatXAI
+from cachetools import TTLCache
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder, HumanMessagePromptTemplate
-from langchain.schema import SystemMessage
+from langchain.schema import SystemMessage, BaseMessage
 from langchain.agents import initialize_agent, Tool, AgentType
 from langchain_core.runnables import RunnablePassthrough
 import os
 from langchain.agents import create_react_agent, AgentExecutor
 
-from ..config import WAIT_TIME, MAX_MESSAGES_PER_BATCH, LLM_MODEL, LLM_TEMPERATURE, XAI_API_KEY
+from ..config import (
+    WAIT_TIME,
+    MAX_MESSAGES_PER_BATCH,
+    TOOL_TIMEOUT,
+    MEMORY_CACHE_SIZE,
+    MEMORY_CACHE_TTL,
+    MEMORY_MAX_TURNS,
+    LANGUAGE_DETECTION_MIN_CHARS
+)
 from ..database.mongodb import db
 from ..utils.text import normalize_text
 from ..utils.language import detect_language
 from ..utils.logging import log_async_performance, get_logger, log_user_interaction
 from .document import document_handler
+from ..services.embedding import embedding_service
+from ..ai.semantic_cache import SemanticCache, response_cache
+from ..ai.agent import llm
 
 # Setup dedicated logger for message pipeline
 msg_logger = get_logger('message_pipeline')
 
+# History reads only need the exchange itself, not batch metadata or stored conversation_history;
+# the filter and sort are served by message_user_processed_timestamp_index
+_HISTORY_PROJECTION = {"message": 1, "response": 1, "timestamp": 1, "_id": 0}
+
+# Fields get_document_context lists for each of the user's documents
+_AVAILABLE_DOCS_PROJECTION = {"metadata.file_name": 1, "upload_time": 1, "status": 1, "_id": 0}
+
+# Sources listed in a Document Query tool result; the agent rarely reads past the first few
+_MAX_TOOL_SOURCES = 5
+
+
+class _FinalAnswerStream:
+    """
+    Forwards the agent's final answer to on_token while it is generated
+    
+    The conversational ReAct agent replies with a JSON blob
+    ({"action": "Final Answer", "action_input": "..."}); only the action_input
+    string is user-facing, so it is decoded and passed on as it grows.
+    """
+    
+    _START = re.compile(r'"action"\s*:\s*"Final Answer"\s*,\s*"action_input"\s*:\s*"')
+    
+    def __init__(self, on_token: Callable[[str], Awaitable[None]]):
+        self.on_token = on_token
+        self._text = ""
+        self._sent = 0
+    
+    def reset(self) -> None:
+        """Start over for a new model call"""
+        self._text = ""
+        self._sent = 0
+    
+    async def feed(self, token: str) -> None:
+        self._text += token
+        match = self._START.search(self._text)
+        if match is None:
+            return
+        
+        # The answer string runs to the first unescaped quote
+        raw = self._text[match.end():]
+        escaped = False
+        for index, char in enumerate(raw):
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                raw = raw[:index]
+                break
+        
+        # A trailing escape may still be incomplete (at most "\uXXX"); decode up to before it
+        for cut in range(len(raw), max(len(raw) - 6, 0) - 1, -1):
+            try:
+                answer = json.loads(f'"{raw[:cut]}"', strict=False)
+                break
+            except ValueError:
+                continue
+        else:
+            return
+        
+        if len(answer) > self._sent:
+            await self.on_token(answer[self._sent:])
+            self._sent = len(answer)
+
+
 class MessageHandler:
     def __init__(self):
-        self.llm = ChatXAI(
-            api_key=XAI_API_KEY,
-            model=LLM_MODEL,
-            temperature=LLM_TEMPERATURE
-        )
-        self.memories = {}
+        # Shared chat model, so both handlers reuse one pooled xAI HTTP client
+        self.llm = llm
+        # Per-user chat memory; idle users are evicted
+        self.memories: TTLCache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=MEMORY_CACHE_TTL)
         self.db = db
+        # Last detected language per user; short follow-ups ("ok", "thanks") reuse it
+        self.user_lang: TTLCache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=MEMORY_CACHE_TTL)
+        # Loop serving process_messages; sync tool calls from worker threads schedule onto it
+        self._loop = None
         self.setup_conversation_chain()
         self.setup_agent_tools()
     
     def setup_conversation_chain(self):
         """Setup the conversation chain with the language model"""
-        prompt = ChatPromptTemplate.from_messages([
-            SystemMessage(content="""You are a helpful AI assistant capable of communicating in multiple languages and analyzing documents.
+        # Never mutated, so every request starts with the same cacheable prefix
+        self.static_system = SystemMessage(content="""You are a helpful AI assistant capable of communicating in multiple languages and analyzing documents.
 
             Your tasks:
             1. Understand user messages in any language
@@ -63,7 +145,9 @@ class MessageHandler:
             - Adapt your personality to the cultural context of the language being used
             - Never ask which document to use - use all relevant document context provided
             - ALWAYS try to use document context in your responses
-            - If you can't find exact information in documents, say what related information you found"""),
+            - If you can't find exact information in documents, say what related information you found""")
+        prompt = ChatPromptTemplate.from_messages([
+            self.static_system,
             MessagesPlaceholder(variable_name="history"),
             HumanMessagePromptTemplate.from_template("{input}")
         ])
@@ -88,6 +172,7 @@ class MessageHandler:
             Tool(
                 name="Document Query",
                 func=self.sync_query_documents,
+                coroutine=self.aquery_documents_tool,
                 description="Search for information in user's documents"
             ),
             Tool(
@@ -134,10 +219,8 @@ Observation: the result of the action"""),
             verbose=True,
             handle_parsing_errors=True,
             max_iterations=3,
-            memory=ConversationBufferMemory(
-                memory_key="chat_history",
-                return_messages=True
-            )
+            # The agent builds its own prompt; without this the static system prompt is never sent
+            agent_kwargs={"system_message": self.static_system.content}
         )
     
     def get_user_memory(self, user_id: str) -> ConversationBufferMemory:
@@ -150,6 +233,28 @@ Observation: the result of the action"""),
             )
         return self.memories[user_id]
     
+    def _remember_turn(self, user_id: str, user_message: str, response: str) -> None:
+        """Append an exchange to the user's memory, keeping only the last MEMORY_MAX_TURNS"""
+        memory = self.get_user_memory(user_id)
+        memory.chat_memory.add_user_message(user_message)
+        memory.chat_memory.add_ai_message(response)
+        del memory.chat_memory.messages[:-2 * MEMORY_MAX_TURNS]
+        # Re-insert to refresh the user's TTL on activity
+        self.memories[user_id] = memory
+    
+    def build_messages(self, user_id: str, dynamic_rag: str) -> List[BaseMessage]:
+        """
+        Chat history for the agent: committed turns first, then this turn's document context
+        
+        History grows by appending (oldest turns drop off past MEMORY_MAX_TURNS), so the
+        system prompt plus history stays a byte-stable prefix across turns; the per-turn
+        context comes after it instead of being spliced into earlier messages.
+        """
+        messages = list(self.get_user_memory(user_id).chat_memory.messages)
+        if dynamic_rag:
+            messages.append(SystemMessage(content=f"Document Context:\n{dynamic_rag}"))
+        return messages
+    
     def get_conversation_history(self, user_id: str) -> str:
         """Get conversation history for a user"""
         # Get recent messages from MongoDB
@@ -158,7 +263,8 @@ Observation: the result of the action"""),
                 "user_id": user_id,
                 "is_processed": True,
                 "response": {"$exists": True}
-            }
+            },
+            projection=_HISTORY_PROJECTION
         ).sort("timestamp", -1).limit(5))
         
         # Format conversation history
@@ -170,6 +276,10 @@ Observation: the result of the action"""),
         
         return "\n".join(history) if history else ""
     
+    def invalidate_user_documents(self, user_id: str) -> None:
+        """Drop cached replies for a user after an upload"""
+        response_cache.invalidate(user_id)
+    
     def analyze_message_intent(self, message: str) -> str:
         """Analyze the intent of a message"""
         prompt = ChatPromptTemplate.from_template(
@@ -185,8 +295,8 @@ Observation: the result of the action"""),
     async def get_document_context(self, query: str, user_id: str) -> Dict[str, Any]:
         """Get relevant context from user's documents"""
         try:
-            # Get user's documents from MongoDB
-            user_docs = self.db.get_user_documents(user_id)
+            # Get user's documents from MongoDB (only the fields listed below)
+            user_docs = await self.db.aget_user_documents(user_id, projection=_AVAILABLE_DOCS_PROJECTION)
             if not user_docs:
                 return {"context": "", "sources": [], "available_docs": []}
 
@@ -199,9 +309,19 @@ Observation: the result of the action"""),
                 status = "✅" if doc.get('status') == "processed" else "❌"
                 available_docs.append(f"- {status} {file_name} (Uploaded: {upload_time})")
 
-            # Query documents with both original query and a summarization query
-            doc_response = await self.query_documents(query, user_id, k=5)
-            summary_response = await self.query_documents("Summarize the key points from all documents", user_id, k=3)
+            # Query documents with both original query and a summarization query; both
+            # searches and answer calls are awaited, so the two run concurrently
+            doc_response, summary_response = await asyncio.gather(
+                self.query_documents(query, user_id, k=5),
+                self.query_documents("Summarize the key points from all documents", user_id, k=3),
+                return_exceptions=True
+            )
+            if isinstance(doc_response, Exception):
+                msg_logger.error(f"❌ Error querying documents: {str(doc_response)}")
+                doc_response = {}
+            if isinstance(summary_response, Exception):
+                msg_logger.error(f"❌ Error querying document summary: {str(summary_response)}")
+                summary_response = {}
 
             # Build context with both specific and general information
             context_parts = []
@@ -248,13 +368,19 @@ Observation: the result of the action"""),
             print(f"Error getting document context: {str(e)}")
             return {"context": "", "sources": [], "available_docs": [], "stats": {}}
     
-    async def process_messages(self, messages: List[Dict[str, Any]], user_id: str) -> str:
-        """Process a batch of messages"""
+    async def process_messages(
+        self,
+        messages: List[Dict[str, Any]],
+        user_id: str,
+        on_token: Optional[Callable[[str], Awaitable[None]]] = None
+    ) -> str:
+        """Process a batch of messages (optionally streaming the answer to on_token as it is generated)"""
         msg_logger.info(f"💬 Starting message processing for user {user_id}")
         msg_logger.info(f"📊 Processing {len(messages)} message(s)")
         
         # Set current user_id for tools
         self.current_user_id = user_id
+        self._loop = asyncio.get_running_loop()
         
         # Log message details
         for i, msg in enumerate(messages):
@@ -267,7 +393,7 @@ Observation: the result of the action"""),
             "user_id": user_id,
             "is_processed": True,
             "response": {"$exists": True}
-        }).sort("timestamp", -1).limit(5))
+        }, projection=_HISTORY_PROJECTION).sort("timestamp", -1).limit(5))
         
         msg_logger.info(f"📜 Found {len(recent_history)} recent conversation entries")
         
@@ -285,9 +411,55 @@ Observation: the result of the action"""),
         msg_logger.info(f"📝 Combined message length: {len(combined_message)} characters")
         msg_logger.debug(f"📄 Combined message preview: '{combined_message[:200]}...'")
         
+        # Seed user memory from stored history once; later turns are appended after each reply
+        memory = self.get_user_memory(user_id)
+        if not memory.chat_memory.messages:
+            msg_logger.debug("🧠 Seeding user memory with conversation history")
+            for msg in conversation_context:
+                if msg.startswith("User: "):
+                    memory.chat_memory.add_user_message(msg[6:])
+                elif msg.startswith("Assistant: "):
+                    memory.chat_memory.add_ai_message(msg[11:])
+            msg_logger.debug(f"💭 Memory seeded with {len(conversation_context)} context entries")
+        
+        # Same or a similar message answered recently after the same last turn: skip
+        # language detection, retrieval and the agent. The cache is keyed on the raw
+        # text; short and follow-up messages depend on the conversation
+        raw_message = combined_message
+        cacheable = response_cache.accepts(raw_message)
+        cached = None
+        if cacheable:
+            cache_context = SemanticCache.context_key([msg.content for msg in memory.chat_memory.messages[-2:]])
+            cached = response_cache.get_exact(user_id, raw_message, cache_context)
+            if cached is None:
+                message_vector = SemanticCache.unit_vector(await embedding_service.embed_query(raw_message))
+                cached = response_cache.get_similar(user_id, message_vector, cache_context)
+        if cached is not None:
+            msg_logger.info(f"♻️ Reusing cached response for user {user_id}")
+            # The turn still happened: keep memory and the stored history complete
+            self._remember_turn(user_id, raw_message, cached)
+            self.db.message_queue.update_one(
+                {"_id": messages[-1]["_id"]},
+                {
+                    "$set": {
+                        "conversation_history": {
+                            "user_message": raw_message,
+                            "assistant_response": cached,
+                            "language": self.user_lang.get(user_id, "unknown"),
+                            "cached": True,
+                            "timestamp": datetime.utcnow()
+                        }
+                    }
+                }
+            )
+            return cached
+        
         # Detect language
-        msg_logger.debug("🌍 Detecting message language")
-        detected_lang = detect_language(combined_message)
+        detected_lang = self.user_lang.get(user_id) if len(combined_message) < LANGUAGE_DETECTION_MIN_CHARS else None
+        if detected_lang is None:
+            msg_logger.debug("🌍 Detecting message language")
+            detected_lang = detect_language(combined_message)
+            self.user_lang[user_id] = detected_lang
         msg_logger.info(f"🗣️  Detected language: {detected_lang}")
         
         # Normalize if Turkish
@@ -295,17 +467,6 @@ Observation: the result of the action"""),
             msg_logger.debug("🔄 Applying Turkish text normalization")
             combined_message = normalize_text(combined_message)
         
-        # Get user memory and update with recent history
-        msg_logger.debug("🧠 Updating user memory with conversation history")
-        memory = self.get_user_memory(user_id)
-        for msg in conversation_context:
-            if msg.startswith("User: "):
-                memory.chat_memory.add_user_message(msg[6:])
-            elif msg.startswith("Assistant: "):
-                memory.chat_memory.add_ai_message(msg[11:])
-        
-        msg_logger.debug(f"💭 Memory updated with {len(conversation_context)} context entries")
-        
         try:
             msg_logger.info("🚀 Starting AI response generation")
             # 1. Generate semantic variations of the query
@@ -326,15 +487,9 @@ Observation: the result of the action"""),
             # 3. Get additional context
             doc_context = await self.get_document_context(combined_message, user_id)
             
-            # 4. Prepare enhanced context
+            # 4. Prepare document context (history is already in the agent's chat history)
             context_parts = []
             
-            # Add conversation history
-            if conversation_context:
-                context_parts.append("Previous Conversation:")
-                context_parts.extend(conversation_context[-6:])  # Last 3 exchanges
-                context_parts.append("")
-            
             # Add available documents
             if doc_context['available_docs']:
                 if detected_lang == 'tr':
@@ -351,14 +506,9 @@ Observation: the result of the action"""),
                 context_parts.append("")
             
             # 5. Create enhanced message with clear instructions
+            document_context = "\n".join(context_parts)
             enhanced_message = f"""User Question: {combined_message}
 
-Previous Context:
-{chr(10).join(conversation_context[-6:])}
-
-Document Context:
-{chr(10).join(context_parts)}
-
 Instructions:
 1. Consider the previous conversation context when responding
 2. Provide a direct and natural response
@@ -369,12 +519,19 @@ Instructions:
 7. If information isn't available, say so briefly
 """
             
-            # 6. Use agent with enhanced context
-            agent_response = await self.agent.ainvoke({
+            # 6. Use agent with enhanced context: static prompt, history, document context, this turn
+            agent_input = {
                 "input": enhanced_message,
-                "chat_history": memory.chat_memory.messages
-            })
+                "chat_history": self.build_messages(user_id, document_context)
+            }
+            if on_token is None:
+                agent_response = await self.agent.ainvoke(agent_input)
+            else:
+                agent_response = await self._stream_agent(agent_input, on_token)
             response = agent_response.get("output", "")
+            self._remember_turn(user_id, combined_message, response)
+            if cacheable and response:
+                response_cache.put(user_id, raw_message, message_vector, response, cache_context)
             
             # 7. Update conversation history with document usage information
             self.db.message_queue.update_one(
@@ -409,8 +566,38 @@ Instructions:
             
             return "Sorry, I couldn't find relevant information in your documents or an error occurred."
     
-    async def process_message_queue(self, user_id: str):
-        """Process messages in the queue for a user"""
+    async def _stream_agent(
+        self,
+        agent_input: Dict[str, Any],
+        on_token: Callable[[str], Awaitable[None]]
+    ) -> Dict[str, Any]:
+        """Run the agent, forwarding its final answer to on_token as it arrives; returns the agent output"""
+        output: Dict[str, Any] = {}
+        answer = _FinalAnswerStream(on_token)
+        tools_running = 0
+        async for event in self.agent.astream_events(agent_input, version="v2"):
+            kind = event["event"]
+            if kind == "on_tool_start":
+                tools_running += 1
+            elif kind == "on_tool_end":
+                tools_running -= 1
+            elif kind == "on_chat_model_start" and not tools_running:
+                answer.reset()
+            elif kind == "on_chat_model_stream" and not tools_running:
+                # Models called inside tools (e.g. document answers) are not the reply
+                chunk = event["data"]["chunk"]
+                if isinstance(chunk.content, str) and chunk.content:
+                    await answer.feed(chunk.content)
+            elif kind == "on_chain_end" and not event.get("parent_ids"):
+                output = event["data"].get("output") or {}
+        return output
+    
+    async def process_message_queue(
+        self,
+        user_id: str,
+        on_token: Optional[Callable[[str], Awaitable[None]]] = None
+    ):
+        """Process messages in the queue for a user (answer tokens go to on_token when given)"""
         try:
             # Wait for additional messages
             await asyncio.sleep(WAIT_TIME)
@@ -419,21 +606,18 @@ Instructions:
             current_time = datetime.utcnow()
             cutoff_time = current_time - timedelta(minutes=5)
             
-            # Get pending messages
-            messages = self.db.get_pending_messages(user_id, cutoff_time, MAX_MESSAGES_PER_BATCH)
+            # Claim pending messages (fetch and mark as processed in one step)
+            # Unique per claim; timestamps collide between workers claiming at the same moment
+            batch_id = uuid.uuid4().hex
+            messages = await self.db.aclaim_pending_messages(user_id, cutoff_time, MAX_MESSAGES_PER_BATCH, batch_id)
             
             if not messages:
                 return
             
-            # Generate batch ID
-            batch_id = str(datetime.utcnow())
             message_ids = [msg["_id"] for msg in messages]
             
-            # Mark messages as being processed
-            self.db.mark_messages_as_processed(message_ids, batch_id)
-            
             # Process messages with RAG
-            response = await self.process_messages(messages, user_id)
+            response = await self.process_messages(messages, user_id, on_token=on_token)
             
             # Update messages with response
             self.db.update_message_response(batch_id, response)
@@ -454,32 +638,42 @@ Instructions:
                 )
             raise
     
+    @staticmethod
+    def _format_document_result(result: Any) -> Dict[str, Any]:
+        """Format a query_documents result for the agent tool"""
+        if isinstance(result, dict):
+            return {
+                "answer": result.get("answer", "No relevant information found."),
+                "sources": [
+                    f"From {metadata.get('file_name', 'Unknown')}: {(s.get('content') or '')[:200]}..."
+                    for s in islice(result.get("sources") or (), _MAX_TOOL_SOURCES)
+                    for metadata in (s.get("metadata", {}),)
+                ]
+            }
+        return {"answer": "No results found", "sources": []}
+    
+    async def aquery_documents_tool(self, query: str) -> Dict[str, Any]:
+        """Async document query for the agent tool (awaited on the serving loop)"""
+        try:
+            result = await document_handler.query_documents(query, self.current_user_id)
+            return self._format_document_result(result)
+            
+        except Exception as e:
+            print(f"Error in aquery_documents_tool: {str(e)}")
+            return {"answer": "Error querying documents", "sources": []}
+    
     def sync_query_documents(self, query: str) -> Dict[str, Any]:
         """Synchronous version of query_documents for the agent tool"""
         try:
-            # Create an event loop if one doesn't exist
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
+            coroutine = document_handler.query_documents(query, self.current_user_id)
+            if self._loop is not None and self._loop.is_running():
+                # Called from a worker thread while process_messages is serving;
+                # hand the query to that loop instead of blocking it
+                result = asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout=TOOL_TIMEOUT)
+            else:
+                result = asyncio.run(coroutine)
             
-            # Run the async function in the event loop
-            result = loop.run_until_complete(
-                document_handler.query_documents(query, self.current_user_id)
-            )
-            
-            # Format the result for better readability
-            if isinstance(result, dict):
-                formatted_result = {
-                    "answer": result.get("answer", "No relevant information found."),
-                    "sources": [
-                        f"From {s['metadata'].get('file_name', 'Unknown')}: {s['content'][:200]}..."
-                        for s in result.get("sources", [])
-                    ]
-                }
-                return formatted_result
-            return {"answer": "No results found", "sources": []}
+            return self._format_document_result(result)
             
         except Exception as e:
             print(f"Error in sync_query_documents: {str(e)}")
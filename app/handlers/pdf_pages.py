@@ -0,0 +1,31 @@
+"""
+PDFium page extraction without any locking.
+
+Runs inside PDF parse worker processes, which start fresh (forkserver/spawn)
+rather than forking the serving process, so this module keeps its imports to
+pypdfium2 alone. In-process callers go through document._extract_pdf_pages,
+which holds the PDFium lock around it.
+"""
+
+from typing import Any, List, Optional
+
+try:
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+
+def read_pdf_pages(source: Any, start: int = 0, end: Optional[int] = None) -> List[str]:
+    """Extract the text of pages [start, end) with PDFium"""
+    pdf = pypdfium2.PdfDocument(source)
+    try:
+        texts = []
+        for index in range(start, len(pdf) if end is None else end):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            texts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return texts
+    finally:
+        pdf.close()
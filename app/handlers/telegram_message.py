@@ -5,14 +5,16 @@ This handler is focused on Telegram-specific message management and uses
 the modular AI service for actual message processing.
 """
 
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Callable, Awaitable
 from datetime import datetime, timedelta
 import asyncio
+import uuid
 
-from ..config import WAIT_TIME, MAX_MESSAGES_PER_BATCH
+from ..config import MAX_MESSAGES_PER_BATCH, BATCH_BIN_WAIT_TIMES, BATCH_BIN_WINDOWS
 from ..database.mongodb import db
 from ..utils.logging import get_logger, log_user_query, log_model_answer
 from ..ai.service import ai_service
+from ..ai.batch_scheduler import BatchScheduler, predict_length_bin
 
 # Setup dedicated logger for message pipeline
 msg_logger = get_logger('telegram_message_handler')
@@ -24,20 +26,39 @@ class TelegramMessageHandler:
     def __init__(self):
         self.db = db
         self.ai_service = ai_service
+        # Ready batches from all users share one scheduler (and concurrency limit) per length bin
+        self.bins = {
+            name: BatchScheduler(self.ai_service.process_user_batch, window=window)
+            for name, window in BATCH_BIN_WINDOWS.items()
+        }
     
-    async def process_message_queue(self, user_id: str, user_name: str = "unknown") -> str:
-        """Process messages in the queue for a user"""
+    async def process_message_queue(
+        self,
+        user_id: str,
+        user_name: str = "unknown",
+        on_token: Optional[Callable[[str], Awaitable[None]]] = None
+    ) -> str:
+        """Process messages in the queue for a user (answer tokens go to on_token as they are generated)"""
         msg_logger.info(f"📥 Processing message queue for user {user_id}")
         try:
+            # Pick a length bin from what is already queued; short questions wait less for follow-ups
+            queued = await self.db.aget_pending_messages(
+                user_id, datetime.utcnow() - timedelta(minutes=5), MAX_MESSAGES_PER_BATCH
+            )
+            length_bin = predict_length_bin(" ".join(msg.get("message", "") for msg in queued))
+            msg_logger.debug(f"🗂️ Using '{length_bin}' bin for user {user_id}")
+
             # Wait for additional messages (batching)
-            await asyncio.sleep(WAIT_TIME)
+            await asyncio.sleep(BATCH_BIN_WAIT_TIMES[length_bin])
 
             # Get cutoff time
             current_time = datetime.utcnow()
             cutoff_time = current_time - timedelta(minutes=5)
 
-            # Get pending messages
-            messages = self.db.get_pending_messages(user_id, cutoff_time, MAX_MESSAGES_PER_BATCH)
+            # Claim pending messages (fetch and mark as processed in one step)
+            # Unique per claim; timestamps collide between workers claiming at the same moment
+            batch_id = uuid.uuid4().hex
+            messages = await self.db.aclaim_pending_messages(user_id, cutoff_time, MAX_MESSAGES_PER_BATCH, batch_id)
 
             if not messages:
                 msg_logger.debug(f"📭 No pending messages for user {user_id}")
@@ -49,21 +70,17 @@ class TelegramMessageHandler:
             for msg in messages:
                 log_user_query(user_id, msg.get("username", user_name), msg.get("text", ""))
 
-            # Generate batch ID and mark messages as being processed
-            batch_id = str(datetime.utcnow())
             message_ids = [msg["_id"] for msg in messages]
-
-            self.db.mark_messages_as_processed(message_ids, batch_id)
             msg_logger.debug(f"🏷️ Marked messages as processed with batch ID: {batch_id}")
 
-            # Process messages with AI service
-            response = await self.ai_service.process_user_messages(messages, user_id)
+            # Process messages with AI service (via the cross-user scheduler for this bin)
+            response, history = await self.bins[length_bin].submit(user_id, messages, on_token=on_token)
 
             # Log model answer
             log_model_answer(user_id, user_name, response)
 
-            # Update messages with response
-            self.db.update_message_response(batch_id, response)
+            # Store the response and conversation history in one bulk write
+            await self.db.acomplete_message_batch(batch_id, message_ids[-1], response, history)
             msg_logger.info(f"✅ Successfully processed and stored response for user {user_id}")
 
             return response
@@ -73,7 +90,7 @@ class TelegramMessageHandler:
 
             # Mark messages with error if we have message_ids
             if 'message_ids' in locals():
-                self.db.message_queue.update_many(
+                await self.db.async_message_queue.update_many(
                     {"_id": {"$in": message_ids}},
                     {
                         "$set": {
@@ -98,6 +115,10 @@ class TelegramMessageHandler:
         """Get list of available AI tools"""
         return self.ai_service.get_agent_tools()
     
+    def invalidate_user_documents(self, user_id: str) -> None:
+        """Drop cached document state for a user after an upload"""
+        self.ai_service.invalidate_user_documents(user_id)
+    
     async def clear_user_memory(self, user_id: str) -> None:
         """Clear conversation memory for a user"""
         await self.ai_service.clear_user_memory(user_id)
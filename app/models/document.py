@@ -43,6 +43,24 @@ class Document:
             "mime_type": mimetypes.guess_type(file_path)[0]
         }
     
+    @classmethod
+    def create_from_bytes(cls, user_id: str, data: bytes, file_name: str) -> 'Document':
+        """Create a new Document instance from content that was never written to disk"""
+        return cls(
+            user_id=user_id,
+            file_path=file_name,
+            file_hash=hashlib.sha256(data).hexdigest(),
+            upload_time=datetime.utcnow(),
+            chunk_count=0,  # Will be updated after processing
+            status="uploaded",
+            metadata={
+                "file_name": file_name,
+                "file_size": len(data),
+                "mime_type": mimetypes.guess_type(file_name)[0]
+            },
+            chunks=[]  # Will be populated with chunks and their embeddings
+        )
+    
     @classmethod
     def create(cls, user_id: str, file_path: str) -> 'Document':
         """Create a new Document instance"""
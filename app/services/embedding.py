@@ -1,5 +1,6 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Awaitable, Deque, Tuple
 import asyncio
+from collections import deque
 import logging
 import time
 from abc import ABC, abstractmethod
@@ -12,7 +13,9 @@ from ..config import (
     EMBEDDING_SERVICE,
     EMBEDDING_MODEL,
     HUGGINGFACE_API_KEY,
-    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_MAX_ITEMS,
+    EMBEDDING_BATCH_MAX_TOKENS,
+    EMBEDDING_BATCH_WINDOW,
     EMBEDDING_MAX_RETRIES,
     EMBEDDING_TIMEOUT
 )
@@ -20,6 +23,85 @@ from ..utils.logging import get_logger, log_async_performance
 
 logger = get_logger('embedding_service')
 
+
+def _count_tokens(text: str) -> int:
+    """Cheap token estimate used to size batches"""
+    return len(text.split())
+
+
+class AsyncRebatcher:
+    """
+    Coalesces concurrent single-text embedding calls into provider-sized batches
+    
+    Callers await embed(text); a background task drains pending texts up to
+    max_items or max_tokens per request, makes one call to embed_batch and
+    hands each caller its own vector.
+    """
+    
+    def __init__(
+        self,
+        embed_batch: Callable[[List[str]], Awaitable[List[List[float]]]],
+        max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+        max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+        window: float = EMBEDDING_BATCH_WINDOW
+    ):
+        self.embed_batch = embed_batch
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.window = window
+        self._pending: Deque[Tuple[str, asyncio.Future]] = deque()
+        self._worker: Optional[asyncio.Task] = None
+    
+    async def embed(self, text: str) -> List[float]:
+        """Embed one text as part of the next batch"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await future
+    
+    async def embed_many(self, texts: List[str]) -> List[Any]:
+        """Embed several texts, in order; a text whose batch failed gets its exception instead of a vector"""
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in texts]
+        self._pending.extend(zip(texts, futures))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await asyncio.gather(*futures, return_exceptions=True)
+    
+    def _next_batch(self) -> List[Tuple[str, asyncio.Future]]:
+        batch = []
+        tokens = 0
+        while self._pending and len(batch) < self.max_items:
+            text_tokens = _count_tokens(self._pending[0][0])
+            if batch and tokens + text_tokens > self.max_tokens:
+                break
+            batch.append(self._pending.popleft())
+            tokens += text_tokens
+        return batch
+    
+    async def _run(self):
+        while self._pending:
+            # Give concurrent callers a moment to join unless a full batch is already waiting
+            if len(self._pending) < self.max_items:
+                await asyncio.sleep(self.window)
+            
+            batch = self._next_batch()
+            try:
+                vectors = await self.embed_batch([text for text, _ in batch])
+                if len(vectors) != len(batch):
+                    raise RuntimeError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+
 class EmbeddingServiceBase(ABC):
     """Base class for embedding services"""
     
@@ -33,6 +115,10 @@ class EmbeddingServiceBase(ABC):
         """Generate embedding for query"""
         pass
     
+    async def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Generate embeddings for several queries"""
+        return [await self.embed_query(query) for query in queries]
+    
     @property
     @abstractmethod
     def dimensions(self) -> int:
@@ -62,6 +148,9 @@ class HuggingFaceEmbeddingService(EmbeddingServiceBase):
         self._dimensions = self._get_model_dimensions(model)
         self.rate_limit_delay = 0.2  # 200ms between requests for stability
         self._client = None  # Lazy initialization
+        self._query_batcher = AsyncRebatcher(self._embed_batch)
+        self._document_batcher = AsyncRebatcher(self._embed_document_batch)
+        self._last_document_request = 0.0
         
     def _get_model_dimensions(self, model: str) -> int:
         """Get embedding dimensions based on model name"""
@@ -186,69 +275,63 @@ class HuggingFaceEmbeddingService(EmbeddingServiceBase):
         if not texts:
             return []
         
-        all_embeddings = []
+        # Concurrent uploads share provider-sized batches instead of each sending their own
+        results = await self._document_batcher.embed_many(texts)
         
-        # Process in batches to respect rate limits
-        for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
-            batch = texts[i:i + EMBEDDING_BATCH_SIZE]
-            
-            try:
-                # Add rate limiting delay
-                if i > 0:
-                    await asyncio.sleep(self.rate_limit_delay)
-                
-                # Prepare payload
-                payload = {
-                    "inputs": batch,
-                    "options": {
-                        "wait_for_model": True,
-                        "use_cache": True
-                    }
-                }
-                
-                batch_embeddings = await self._make_request(payload)
-                
-                if batch_embeddings:
-                    all_embeddings.extend(batch_embeddings)
-                    logger.info(f"Generated embeddings for batch {i//EMBEDDING_BATCH_SIZE + 1}, {len(batch)} texts")
-                else:
-                    # Add zero embeddings for failed batch
-                    zero_embedding = [0.0] * self.dimensions
-                    all_embeddings.extend([zero_embedding] * len(batch))
-                    logger.error(f"Failed to generate embeddings for batch {i//EMBEDDING_BATCH_SIZE + 1}")
-                
-            except Exception as e:
-                logger.error(f"Error generating embeddings for batch {i//EMBEDDING_BATCH_SIZE + 1}: {str(e)}")
-                # Add zero embeddings for failed batch
-                zero_embedding = [0.0] * self.dimensions
-                all_embeddings.extend([zero_embedding] * len(batch))
-        
-        return all_embeddings
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        if failed:
+            logger.error(f"Failed to generate embeddings for {failed} of {len(texts)} texts")
+        zero_embedding = [0.0] * self.dimensions
+        return [zero_embedding if isinstance(result, Exception) else result for result in results]
+    
+    async def _embed_document_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed one batch of document texts, spacing requests to respect rate limits"""
+        delay = self._last_document_request + self.rate_limit_delay - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            embeddings = await self._embed_batch(texts)
+        finally:
+            self._last_document_request = time.monotonic()
+        logger.info(f"Generated embeddings for batch of {len(texts)} texts")
+        return embeddings
+    
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed one batch of texts in a single request"""
+        payload = {
+            "inputs": texts,
+            "options": {
+                "wait_for_model": True,
+                "use_cache": True
+            }
+        }
+        return await self._make_request(payload)
     
     @log_async_performance("embedding_service")
     async def embed_query(self, query: str) -> List[float]:
-        """Generate embedding for query"""
+        """Generate embedding for query (concurrent queries share one request)"""
         try:
-            payload = {
-                "inputs": [query],
-                "options": {
-                    "wait_for_model": True,
-                    "use_cache": True
-                }
-            }
-            
-            result = await self._make_request(payload)
-            
-            if result and len(result) > 0:
-                return result[0]
-            else:
-                logger.error("Failed to generate query embedding")
-                return [0.0] * self.dimensions
+            return await self._query_batcher.embed(query)
                 
         except Exception as e:
             logger.error(f"Error generating query embedding: {str(e)}")
             return [0.0] * self.dimensions
     
+    @log_async_performance("embedding_service")
+    async def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Generate embeddings for several queries in one request"""
+        if not queries:
+            return []
+        
+        try:
+            embeddings = await self._embed_batch(queries)
+            if len(embeddings) == len(queries):
+                return embeddings
+            logger.error(f"Expected {len(queries)} query embeddings, got {len(embeddings)}")
+        except Exception as e:
+            logger.error(f"Error generating query embeddings: {str(e)}")
+        return [[0.0] * self.dimensions for _ in queries]
+    
     @property
     def dimensions(self) -> int:
         return self._dimensions
@@ -6,36 +6,72 @@ AI processing to the modular AI service.
 """
 
 import os
+import io
 import asyncio
+import weakref
 from datetime import datetime
+from cachetools import TTLCache
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.error import BadRequest
 
-from ..config import TELEGRAM_BOT_TOKEN, DOCUMENT_UPLOAD_PATH
+from ..config import (
+    TELEGRAM_BOT_TOKEN,
+    DOCUMENT_UPLOAD_PATH,
+    DOCUMENT_IN_MEMORY_MAX_BYTES,
+    ensure_dirs,
+    USER_CONTEXT_CACHE_SIZE,
+    USER_CONTEXT_TTL
+)
 from ..handlers.telegram_message import telegram_message_handler
 from ..handlers.document import document_handler
 from ..utils.language import detect_language
+from ..utils.text import split_message
 from ..utils.logging import log_user_interaction, get_logger
-from ..database.mongodb import db
+from ..database.mongodb import db, get_db
 from ..models.message import Message
+from .streaming import StreamingReply
 
 # Get logger for bot operations
 bot_logger = get_logger('telegram_bot')
 
+# Only the fields /docs displays
+_DOCUMENT_LIST_FIELDS = {"status": 1, "file_path": 1, "metadata.file_name": 1, "upload_time": 1}
+
 
 class TelegramBot:
     """Telegram Bot with clean separation of concerns"""
     
     def __init__(self):
-        self.app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        self.app = self._build_application()
         self.setup_handlers()
-        self.processing_users = set()
-        self.user_contexts = {}  # Store user contexts for replies
-        os.makedirs(DOCUMENT_UPLOAD_PATH, exist_ok=True)
+        # One lock per user serializes queue processing; held while a run is in progress.
+        # Weak values: a lock disappears once no run or caller holds it, so idle users cost nothing
+        self._user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        # Store user contexts for replies; idle users are evicted
+        self.user_contexts = TTLCache(maxsize=USER_CONTEXT_CACHE_SIZE, ttl=USER_CONTEXT_TTL)
+        ensure_dirs()
         
         bot_logger.info("🤖 Telegram Bot initialized")
 
+    @staticmethod
+    def _build_application() -> Application:
+        """Build the Telegram application, throttled to Telegram's limits when possible"""
+        builder = Application.builder().token(TELEGRAM_BOT_TOKEN)
+        try:
+            builder = builder.rate_limiter(AIORateLimiter())
+        except RuntimeError:
+            # python-telegram-bot[rate-limiter] extra not installed; rely on Telegram's flood control
+            pass
+        return builder.build()
+
+    def _user_lock(self, user_id: str) -> asyncio.Lock:
+        """Get the processing lock for a user"""
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        return lock
+
     def setup_handlers(self):
         """Setup message and command handlers"""
         self.app.add_handler(CommandHandler("start", self.start_command))
@@ -63,22 +99,23 @@ class TelegramBot:
     async def list_documents(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /docs command"""
         user_id = str(update.effective_user.id)
-        docs = db.get_user_documents(user_id)
+        docs = await db.aget_user_documents(user_id, projection=_DOCUMENT_LIST_FIELDS)
         
         if not docs:
             await update.message.reply_text("You haven't uploaded any documents yet.")
             return
         
-        response = "Your uploaded documents:\n\n"
-        for doc in docs:
-            status = "✅" if doc.get("status") == "processed" else "❌"
-            file_path = doc.get('file_path', '')
-            if file_path:
-                file_name = os.path.basename(file_path)
-            else:
-                file_name = doc.get('metadata', {}).get('file_name', 'Unknown')
-            upload_time = doc.get('upload_time', datetime.utcnow()).strftime('%Y-%m-%d %H:%M')
-            response += f"{status} {file_name} - {upload_time}\n"
+        basename = os.path.basename
+        now = datetime.utcnow()
+        lines = [
+            "{status} {file_name} - {upload_time}\n".format(
+                status="✅" if doc.get("status") == "processed" else "❌",
+                file_name=basename(doc['file_path']) if doc.get('file_path') else doc.get('metadata', {}).get('file_name', 'Unknown'),
+                upload_time=doc.get('upload_time', now).strftime('%Y-%m-%d %H:%M')
+            )
+            for doc in docs
+        ]
+        response = "Your uploaded documents:\n\n" + "".join(lines)
         
         await update.message.reply_text(response)
         bot_logger.info(f"📋 Documents listed for user {user_id}")
@@ -126,14 +163,26 @@ class TelegramBot:
             'update': update
         }
         
-        # Download file
         file = await context.bot.get_file(document.file_id)
-        file_path = os.path.join(DOCUMENT_UPLOAD_PATH, f"{user_id}_{document.file_name}")
-        await file.download_to_drive(file_path)
+        file_name = f"{user_id}_{document.file_name}"
+        file_path = None
         
         try:
-            # Process document
-            result = await document_handler.process_document(file_path, user_id)
+            # Small documents of supported types are read straight from memory
+            if (
+                document.file_size is not None
+                and document.file_size <= DOCUMENT_IN_MEMORY_MAX_BYTES
+                and document_handler.supports_in_memory(file_name)
+            ):
+                buffer = io.BytesIO()
+                await file.download_to_memory(out=buffer)
+                result = await document_handler.process_document_bytes(buffer.getvalue(), file_name, user_id)
+            else:
+                # Download file
+                file_path = os.path.join(DOCUMENT_UPLOAD_PATH, file_name)
+                await file.download_to_drive(file_path)
+                result = await document_handler.process_document(file_path, user_id)
+            telegram_message_handler.invalidate_user_documents(user_id)
             
             if result["status"] == "exists":
                 await update.message.reply_text("This document has already been uploaded and processed.")
@@ -143,8 +192,7 @@ class TelegramBot:
                 )
                 
                 # Schedule message processing if not already processing for this user
-                if user_id not in self.processing_users:
-                    self.processing_users.add(user_id)
+                if not self._user_lock(user_id).locked():
                     asyncio.create_task(self._process_messages(user_id))
                 
         except Exception as e:
@@ -152,7 +200,7 @@ class TelegramBot:
             bot_logger.error(f"❌ Document processing error for user {user_id}: {str(e)}")
         finally:
             # Clean up downloaded file
-            if os.path.exists(file_path):
+            if file_path and os.path.exists(file_path):
                 os.remove(file_path)
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -196,41 +244,48 @@ class TelegramBot:
         await db.insert_message(message_obj)
         
         # Schedule message processing if not already processing for this user
-        if user_id not in self.processing_users:
-            self.processing_users.add(user_id)
+        if not self._user_lock(user_id).locked():
             asyncio.create_task(self._process_messages(user_id))
 
     async def _process_messages(self, user_id: str):
         """Process messages for a user using the Telegram message handler"""
         bot_logger.debug(f"🔄 Starting message processing for user {user_id}")
         
+        lock = self._user_lock(user_id)
         try:
-            # Use the telegram message handler to process the queue
-            response = await telegram_message_handler.process_message_queue(user_id)
-            
-            if response:
-                # Get user context for proper reply
+            async with lock:
+                # Get user context for proper reply; the answer is streamed into the chat as it is generated
                 user_context = self.user_contexts.get(user_id)
-                if user_context:
-                    # Split long messages and reply in the same chat
-                    await self._send_long_message(user_context, response)
-                    bot_logger.info(f"✅ Response sent to user {user_id}")
-                else:
-                    bot_logger.warning(f"⚠️ No context found for user {user_id}")
+                stream = None
+                if user_context and user_context.get('chat_id') is not None:
+                    stream = StreamingReply(self.app.bot, user_context['chat_id'])
+                
+                # Use the telegram message handler to process the queue
+                response = await telegram_message_handler.process_message_queue(
+                    user_id, on_token=stream.on_token if stream else None
+                )
+            
+                if response:
+                    if user_context:
+                        # Replace the streamed preview, or split long messages and reply in the same chat
+                        if not (stream and await stream.finish(response)):
+                            await self._send_long_message(user_context, response)
+                        bot_logger.info(f"✅ Response sent to user {user_id}")
+                    else:
+                        bot_logger.warning(f"⚠️ No context found for user {user_id}")
         except Exception as e:
             bot_logger.error(f"❌ Error processing messages for user {user_id}: {str(e)}")
         finally:
-            self.processing_users.discard(user_id)
-            
             # Check for more pending messages
             try:
-                pending_messages = db.message_queue.count_documents({
-                    "user_id": user_id,
-                    "is_processed": False
-                })
+                # Only existence matters, so stop at the first match instead of counting
+                pending_exists = await db.async_message_queue.find_one(
+                    {"user_id": user_id, "is_processed": False},
+                    projection={"_id": 1}
+                ) is not None
                 
-                if pending_messages > 0:
-                    self.processing_users.add(user_id)
+                # A run that already holds the lock will pick these up itself
+                if pending_exists and not lock.locked():
                     try:
                         asyncio.create_task(self._process_messages(user_id))
                     except RuntimeError:
@@ -253,31 +308,12 @@ class TelegramBot:
                 await self.app.bot.send_message(chat_id=chat_id, text=text)
                 return
 
-            # Split message into parts
-            parts = []
-            current_part = ""
-            
-            # Split by paragraphs first
-            paragraphs = text.split("\n\n")
-            
-            for paragraph in paragraphs:
-                # If adding this paragraph would exceed max_length
-                if len(current_part) + len(paragraph) + 2 > max_length:
-                    # If current_part is not empty, add it to parts
-                    if current_part:
-                        parts.append(current_part.strip())
-                    current_part = paragraph
-                else:
-                    # Add paragraph to current_part
-                    if current_part:
-                        current_part += "\n\n"
-                    current_part += paragraph
-            
-            # Add the last part if not empty
-            if current_part:
-                parts.append(current_part.strip())
+            # Split message into parts, keeping paragraphs together
+            parts = split_message(text, max_length)
             
-            # Send each part with a part number if multiple parts
+            # Send each part with a part number if multiple parts, each replying to the previous one so
+            # the order is explicit in the chat without pausing between sends
+            previous_id = None
             total_parts = len(parts)
             for i, part in enumerate(parts, 1):
                 if total_parts > 1:
@@ -287,20 +323,22 @@ class TelegramBot:
                     message = part
                 
                 try:
-                    await self.app.bot.send_message(chat_id=chat_id, text=message)
-                    # Add a small delay between messages to maintain order
-                    if i < total_parts:
-                        await asyncio.sleep(0.5)
+                    sent = await self.app.bot.send_message(
+                        chat_id=chat_id, text=message, reply_to_message_id=previous_id
+                    )
+                    previous_id = sent.message_id
                 except Exception as e:
                     bot_logger.error(f"❌ Error sending message part {i}: {str(e)}")
                     # If a part is still too long, split it further
                     if isinstance(e, BadRequest) and "Message is too long" in str(e):
-                        # Split into smaller parts
-                        subparts = [message[j:j + max_length] for j in range(0, len(message), max_length)]
+                        # Split into smaller parts; Telegram counts UTF-16 units, so leave headroom
+                        subparts = split_message(message, max_length // 2)
                         for subpart in subparts:
                             try:
-                                await self.app.bot.send_message(chat_id=chat_id, text=subpart)
-                                await asyncio.sleep(0.5)
+                                sent = await self.app.bot.send_message(
+                                    chat_id=chat_id, text=subpart, reply_to_message_id=previous_id
+                                )
+                                previous_id = sent.message_id
                             except Exception as sub_e:
                                 bot_logger.error(f"❌ Error sending message subpart: {str(sub_e)}")
                                 
@@ -317,6 +355,9 @@ class TelegramBot:
 
     async def start(self):
         """Start the bot"""
+        # Connect (and set up indexes) before polling, off the event loop, so the first
+        # update does not pay for it inside a handler
+        await asyncio.to_thread(get_db)
         await self.app.initialize()
         await self.app.start()
         await self.app.updater.start_polling()
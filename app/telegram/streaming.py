@@ -0,0 +1,79 @@
+"""
+Streamed Telegram replies.
+
+A reply is sent as soon as its first tokens arrive and then edited in place
+while the rest is generated. Shared by both bot implementations.
+"""
+
+import asyncio
+from typing import List, Optional
+from telegram.error import BadRequest, RetryAfter
+
+from ..config import STREAM_EDIT_INTERVAL
+from ..utils.logging import get_logger
+
+bot_logger = get_logger('telegram_bot')
+
+
+class StreamingReply:
+    """Shows a reply while it is generated by sending it once and editing it as tokens arrive"""
+
+    def __init__(self, bot, chat_id: int, max_length: int = 4000, interval: float = STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.max_length = max_length
+        self.interval = interval
+        self.message_id: Optional[int] = None
+        self._tokens: List[str] = []
+        self._shown = ""
+        self._last_edit = 0.0
+
+    async def on_token(self, token: str) -> None:
+        """Buffer a token; the message is updated at most once per interval"""
+        self._tokens.append(token)
+        now = asyncio.get_running_loop().time()
+        if now - self._last_edit >= self.interval:
+            self._last_edit = now
+            await self._show("".join(self._tokens)[:self.max_length])
+
+    async def _show(self, text: str) -> None:
+        if not text.strip() or text == self._shown:
+            return
+        try:
+            if self.message_id is None:
+                sent = await self.bot.send_message(chat_id=self.chat_id, text=text)
+                self.message_id = sent.message_id
+            else:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+            self._shown = text
+        except RetryAfter as e:
+            # Flood control: hold further preview edits until Telegram allows them again
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            self._last_edit = asyncio.get_running_loop().time() + retry_after
+            bot_logger.warning(f"⚠️ Streamed reply rate limited in chat {self.chat_id}, pausing edits for {retry_after}s")
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                bot_logger.debug(f"⚠️ Streamed reply unchanged: {str(e)}")
+            else:
+                bot_logger.warning(f"⚠️ Could not update streamed reply: {str(e)}")
+        except Exception as e:
+            # A missed preview update is harmless; finish() still delivers the full reply
+            bot_logger.warning(f"⚠️ Could not update streamed reply: {str(e)}")
+
+    async def finish(self, response: str) -> bool:
+        """Show the final response in the streamed message; False if it still has to be sent"""
+        if self.message_id is None:
+            return False
+        if len(response) > self.max_length:
+            # Too long for one message: drop the preview and let the caller send it in parts
+            try:
+                await self.bot.delete_message(chat_id=self.chat_id, message_id=self.message_id)
+            except Exception as e:
+                bot_logger.warning(f"⚠️ Could not delete streamed reply: {str(e)}")
+            return False
+        # Wait out any flood-control pause so the final edit is not rejected as well
+        delay = self._last_edit - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._show(response)
+        return self._shown == response
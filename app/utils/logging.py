@@ -287,6 +287,8 @@ performance_logger = logging.getLogger("performance")
 def log_user_interaction(user_id: int, username: str, action: str, details: Optional[Dict[str, Any]] = None):
     """Log user interactions for analytics and debugging."""
     interaction_logger = logging.getLogger('user_interactions')
+    if not interaction_logger.isEnabledFor(logging.INFO):
+        return
     
     log_data = {
         'user_id': user_id,
@@ -299,7 +301,7 @@ def log_user_interaction(user_id: int, username: str, action: str, details: Opti
         log_data.update(details)
     
     interaction_logger.info(
-        f"👤 User {username} ({user_id}) performed {action}",
+        "👤 User %s (%s) performed %s", username, user_id, action,
         extra=log_data
     )
 
@@ -1,15 +1,68 @@
+import textwrap
+from typing import Iterator, List, Tuple
+
+
+# Turkish characters and their ASCII equivalents, applied in a single pass
+_TURKISH_TO_ASCII = str.maketrans({
+    'ğ': 'g', 'Ğ': 'G',
+    'ü': 'u', 'Ü': 'U',
+    'ş': 's', 'Ş': 'S',
+    'ı': 'i', 'İ': 'I',
+    'ö': 'o', 'Ö': 'O',
+    'ç': 'c', 'Ç': 'C'
+})
+
+
 def normalize_text(text: str) -> str:
     """
     Normalize text by converting Turkish characters to their ASCII equivalents
     """
-    turkish_chars = {
-        'ğ': 'g', 'Ğ': 'G',
-        'ü': 'u', 'Ü': 'U',
-        'ş': 's', 'Ş': 'S',
-        'ı': 'i', 'İ': 'I',
-        'ö': 'o', 'Ö': 'O',
-        'ç': 'c', 'Ç': 'C'
-    }
-    for tr, eng in turkish_chars.items():
-        text = text.replace(tr, eng)
-    return text
+    return text.translate(_TURKISH_TO_ASCII)
+
+
+def _message_pieces(text: str, max_length: int) -> Iterator[Tuple[str, str]]:
+    """
+    Yield (separator, piece) pairs that rebuild text when joined: whole paragraphs
+    where they fit, otherwise their lines, and word-wrapped chunks of lines that
+    are still too long
+    """
+    for paragraph in text.split("\n\n"):
+        separator = "\n\n"
+        lines = [paragraph] if len(paragraph) <= max_length else paragraph.split("\n")
+        for line in lines:
+            if len(line) <= max_length:
+                pieces = [line]
+            else:
+                pieces = textwrap.wrap(line, max_length, break_on_hyphens=False) or [line]
+            for piece in pieces:
+                yield separator, piece
+                separator = " "
+            separator = "\n"
+
+
+def split_message(text: str, max_length: int) -> List[str]:
+    """
+    Split text into parts of at most max_length characters, packing whole
+    paragraphs into each part; paragraphs that are too long on their own are
+    split on line breaks first and wrapped only where a single line is too long
+    """
+    parts = []
+    buf: List[str] = []  # piece, separator, piece, ... of the part being packed
+    size = 0
+    for separator, piece in _message_pieces(text, max_length):
+        if not buf and not piece.strip():
+            continue  # a part never starts with blank lines
+        if buf and size + len(separator) + len(piece) > max_length:
+            parts.append("".join(buf).rstrip())
+            buf = []
+            size = 0
+        if buf:
+            buf.append(separator)
+            size += len(separator)
+        buf.append(piece)
+        size += len(piece)
+    
+    if buf:
+        parts.append("".join(buf).rstrip())
+    # Leading indentation is kept; it belongs to code and nested lists
+    return [part for part in parts if part.strip()]
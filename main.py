@@ -41,4 +41,5 @@ async def root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" runs on uvloop when it is installed, otherwise the default asyncio loop
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto")
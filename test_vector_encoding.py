@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Vector encoding test
+
+Checks that embeddings packed for MongoDB as float32 binData vectors match
+pymongo's own encoding and decode back to the same (unit-length) values.
+No database connection is needed.
+"""
+
+import os
+import sys
+
+import numpy as np
+from bson.binary import Binary, BinaryVectorDtype
+
+# Add the project root to Python path
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Importing the database module needs a URI, but nothing here connects
+os.environ.setdefault("DOCEXPERT_SKIP_DOTENV", "1")
+os.environ.setdefault("MONGODB_USERNAME", "test")
+os.environ.setdefault("MONGODB_PASSWORD", "test")
+os.environ.setdefault("MONGODB_CLUSTER", "localhost")
+
+from app.database.mongodb import to_float32_vectors, unit_vectors
+from app.database.vector_index import decode_vector
+
+
+def test_float32_vector_round_trip():
+    """Packed vectors equal Binary.from_vector and decode to the normalized input"""
+    embeddings = [[3.0, 4.0, 0.0], [0.5, -0.25, 1.0], [0.0, 0.0, 0.0]]
+    expected = unit_vectors(embeddings)
+
+    packed = to_float32_vectors(embeddings)
+
+    assert len(packed) == len(embeddings)
+    for binary, row in zip(packed, expected):
+        assert binary == Binary.from_vector(row.tolist(), BinaryVectorDtype.FLOAT32)
+        np.testing.assert_allclose(decode_vector(bytes(binary)), row, rtol=1e-6)
+        np.testing.assert_allclose(binary.as_vector().data, row, rtol=1e-6)
+
+    # Zero vectors stay zero instead of becoming NaN
+    assert not decode_vector(bytes(packed[2])).any()
+
+
+if __name__ == "__main__":
+    test_float32_vector_round_trip()
+    print("✅ Vector encoding round trip passed")